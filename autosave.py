@@ -0,0 +1,456 @@
+# coding: utf8
+# Autosave: a journal of what changed, plus a save now and then
+# Everything that changes the game as it goes (moves, damage, items picked up and dropped, tiles explored,
+# messages, taking the stairs) is appended to the journal file as a small record, a turn's worth at a time.
+# Every AUTOSAVE_INTERVAL seconds the game is copied (savefile.capture_game, cheap) and a background thread
+# writes that as the new save, so the journal only has to go back to it. After a crash, load the save and
+# replay the journal on top of it
+#
+# journal: b"RLJN", version (uint16), then records: tag (1 byte), length, crc32 of the payload, payload
+# A record cut short by a crash fails its length or crc, and everything from there on is ignored
+#
+# Entities are referred to by number. At the start of every segment (S record, one per save) they are
+# numbered in the order of the entity list, with the inventories right after their owner; that's the order
+# the save has them in, so the reader numbers them the same way. New entities get the next numbers
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+import constants
+import gamelog
+import savefile
+from savefile import struct_Cursor
+
+LOG = gamelog.get_logger('autosave')
+
+MAGIC = b"RLJN"
+JOURNAL_VERSION = 1
+
+# a new segment: the save with this number has everything before it
+REC_SEGMENT = b"S"
+# an entity moved
+REC_MOVE = b"M"
+# a creature's hp changed
+REC_HP = b"H"
+# a new entity on the map, packed as in the save
+REC_ADD = b"A"
+# an entity we know already is back on the map (e.g. a dropped item)
+REC_PLACE = b"P"
+REC_REMOVE = b"R"
+# an item went into or out of an inventory
+REC_TAKE = b"T"
+REC_GIVE = b"G"
+REC_EQUIP = b"E"
+REC_EXPLORED = b"X"
+REC_MESSAGE = b"W"
+# took the stairs, the level change itself isn't journaled, replaying it makes the same level again
+REC_LEVEL = b"L"
+
+_HEADER = struct.Struct("<4sH")
+_RECORD = struct.Struct("<cII")
+_U32 = struct.Struct("<I")
+_POSITION = struct.Struct("<Iii")
+_HP = struct.Struct("<Ii")
+_PAIR = struct.Struct("<II")
+_EQUIP = struct.Struct("<IIB")
+_DEPTH = struct.Struct("<i")
+
+
+# the entities of a level in numbering order
+def numbered(entities):
+    for ent in entities:
+        yield ent
+        if ent.container:
+            for item in numbered(ent.container.inventory):
+                yield item
+
+
+class obj_Journal(object):
+    def __init__(self, path=constants.JOURNAL_FILE):
+        self.path = path
+        self.file = None
+        # how long the file is, including what hasn't been written yet
+        self.size = 0
+        self.pending = []
+        # segment -> where its S record is in the file
+        self.segments = {}
+        self.seq = 0
+        # records since the last segment
+        self.records = 0
+        # entity <-> number for this segment
+        self.ids = {}
+        self.entities = {}
+        self.next_id = 0
+        # while the level changes, see level_changing
+        self.paused = False
+        # took the stairs, the next tick saves
+        self.save_due = False
+
+    # seq: the last segment number in the file (or in the save), append: keep what the file has
+    def open(self, seq=0, append=False):
+        self.seq = seq
+        self.segments = {}
+        if append and os.path.exists(self.path):
+            with open(self.path, 'rb') as journal_file:
+                data = journal_file.read()
+            if _has_header(data):
+                # a record the crash cut short would hide everything after it
+                self.size = _HEADER.size
+                for offset, tag, payload in _records(data):
+                    self.size = offset + _RECORD.size + len(payload)
+                self.file = open(self.path, 'r+b')
+                self.file.truncate(self.size)
+                self.file.seek(self.size)
+                return
+        self.file = open(self.path, 'wb')
+        self.file.write(_HEADER.pack(MAGIC, JOURNAL_VERSION))
+        self.size = _HEADER.size
+
+    def _record(self, tag, payload):
+        if self.paused:
+            return
+        self.pending.append(_RECORD.pack(tag, len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+        self.size += _RECORD.size + len(payload)
+        self.records += 1
+
+    def _number(self, entities):
+        self.ids = {}
+        self.entities = {}
+        self.next_id = 0
+        for ent in numbered(entities):
+            self._register(ent)
+
+    def _register(self, ent):
+        number = self.next_id
+        self.ids[ent] = number
+        self.entities[number] = ent
+        self.next_id += 1
+        return number
+
+    def _id(self, ent):
+        number = self.ids.get(ent)
+        if number is None:
+            LOG.warning("%s isn't in the journal", ent.name)
+        return number
+
+    # starts a new segment for a save of the game as it is now, returns its number
+    def new_segment(self, entities):
+        self.seq += 1
+        self.segments[self.seq] = self.size
+        self._record(REC_SEGMENT, _U32.pack(self.seq))
+        self._number(entities)
+        self.records = 0
+        return self.seq
+
+    def moved(self, ent):
+        number = self._id(ent)
+        if number is not None:
+            self._record(REC_MOVE, _POSITION.pack(number, ent.x, ent.y))
+
+    def hp_changed(self, ent):
+        number = self._id(ent)
+        if number is not None:
+            self._record(REC_HP, _HP.pack(number, ent.creature.hp))
+
+    def added(self, ent):
+        if self.paused:
+            return
+        number = self.ids.get(ent)
+        if number is not None:
+            self._record(REC_PLACE, _POSITION.pack(number, ent.x, ent.y))
+            return
+        number = self.next_id
+        for new_ent in numbered([ent]):
+            self._register(new_ent)
+        self._record(REC_ADD, _U32.pack(number) + savefile.pack_entity(ent))
+
+    def removed(self, ent):
+        number = self._id(ent)
+        if number is not None:
+            self._record(REC_REMOVE, _U32.pack(number))
+
+    def inventory_added(self, actor, item):
+        self._pair(REC_TAKE, actor, item)
+
+    def inventory_removed(self, actor, item):
+        self._pair(REC_GIVE, actor, item)
+
+    def _pair(self, tag, actor, item):
+        actor_id, item_id = self._id(actor), self._id(item)
+        if actor_id is not None and item_id is not None:
+            self._record(tag, _PAIR.pack(actor_id, item_id))
+
+    def equipped(self, actor, item, equipped):
+        actor_id, item_id = self._id(actor), self._id(item)
+        if actor_id is not None and item_id is not None:
+            self._record(REC_EQUIP, _EQUIP.pack(actor_id, item_id, 1 if equipped else 0))
+
+    # the cells of visible that weren't explored before are now
+    def explored(self, grid, visible):
+        explored = grid.explored
+        new = [index for index in visible if not explored[index]]
+        if not new:
+            return
+        for index in new:
+            explored[index] = 1
+        self._record(REC_EXPLORED, struct.pack("<%dI" % len(new), *new))
+
+    def message(self, msg, color):
+        self._record(REC_MESSAGE, savefile.pack_str(msg) + savefile.pack_str(color))
+
+    # around obj_Game.change_level: the change is one record, what it does to the entities isn't journaled
+    def level_changing(self, depth):
+        self._record(REC_LEVEL, _DEPTH.pack(depth))
+        self.paused = True
+
+    def level_changed(self, entities):
+        self.paused = False
+        self._number(entities)
+        self.save_due = True
+
+    # to the file (a turn at a time)
+    def flush(self):
+        if self.pending:
+            self.file.write(b"".join(self.pending))
+            self.pending = []
+            self.file.flush()
+
+    # and to the disk
+    def sync(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    # the save for segment seq is on disk, so the file can start there
+    def truncate(self, seq):
+        start = self.segments.get(seq)
+        if start is None:
+            return
+        self.flush()
+        self.file.close()
+        with open(self.path, 'rb') as journal_file:
+            journal_file.seek(start)
+            tail = journal_file.read()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(_HEADER.pack(MAGIC, JOURNAL_VERSION))
+            temp_file.write(tail)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        savefile.replace_file(temp_path, self.path)
+        self.file = open(self.path, 'ab')
+        shift = start - _HEADER.size
+        self.segments = dict((segment, offset - shift) for segment, offset in self.segments.items()
+                             if segment >= seq)
+        self.size -= shift
+
+    # remove: the save has everything, the journal isn't needed anymore
+    def close(self, remove=False):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _has_header(data):
+    return len(data) >= _HEADER.size and _HEADER.unpack_from(data, 0) == (MAGIC, JOURNAL_VERSION)
+
+
+# (offset, tag, payload) of every record, up to the first one a crash cut short
+def _records(data):
+    offset = _HEADER.size
+    while offset + _RECORD.size <= len(data):
+        tag, length, crc = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            LOG.warning("journal ends with a broken record at %d", offset)
+            return
+        yield offset, tag, payload
+        offset = start + length
+
+
+# The records of the journal from segment seq on, and the last segment number in the file
+# Records of older segments are already in the save
+def read_journal(path, seq):
+    records = []
+    last_seq = seq
+    if not os.path.exists(path):
+        return records, last_seq
+    with open(path, 'rb') as journal_file:
+        data = journal_file.read()
+    if not _has_header(data):
+        LOG.warning("%s is not a journal, ignoring it", path)
+        return records, last_seq
+
+    keep = False
+    for offset, tag, payload in _records(data):
+        if tag == REC_SEGMENT:
+            segment, = _U32.unpack(payload)
+            last_seq = max(last_seq, segment)
+            keep = segment >= seq
+        if keep:
+            records.append((tag, payload))
+    return records, last_seq
+
+
+# Applies records from read_journal to a loaded game, returns how many there were
+# The game is changed through its usual methods, with main.JOURNAL off so nothing is journaled twice
+def replay(records, game, registry):
+    entities = {}
+    for tag, payload in records:
+        cursor = struct_Cursor(payload)
+        if tag == REC_SEGMENT or tag == REC_LEVEL:
+            if tag == REC_LEVEL:
+                depth, = cursor.unpack(_DEPTH)
+                game.change_level(depth)
+            entities = dict(enumerate(numbered(game.current_entities)))
+        elif tag == REC_MOVE:
+            number, x, y = cursor.unpack(_POSITION)
+            ent = entities[number]
+            ent.x, ent.y = x, y
+        elif tag == REC_HP:
+            number, hp = cursor.unpack(_HP)
+            entities[number].creature.hp = hp
+        elif tag == REC_ADD:
+            number, = cursor.unpack(_U32)
+            ent = savefile.unpack_entity(cursor, registry)
+            for new_ent in numbered([ent]):
+                entities[number] = new_ent
+                number += 1
+            game.add_entity(ent)
+        elif tag == REC_PLACE:
+            number, x, y = cursor.unpack(_POSITION)
+            ent = entities[number]
+            ent.x, ent.y = x, y
+            game.add_entity(ent)
+        elif tag == REC_REMOVE:
+            number, = cursor.unpack(_U32)
+            game.remove_entity(entities[number])
+        elif tag == REC_TAKE:
+            actor_id, item_id = cursor.unpack(_PAIR)
+            container, item = entities[actor_id].container, entities[item_id]
+            container.inventory.append(item)
+            item.item.current_container = container
+        elif tag == REC_GIVE:
+            actor_id, item_id = cursor.unpack(_PAIR)
+            entities[actor_id].container.inventory.remove(entities[item_id])
+        elif tag == REC_EQUIP:
+            actor_id, item_id, equipped = cursor.unpack(_EQUIP)
+            container, equipment = entities[actor_id].container, entities[item_id].equipment
+            equipment.equipped = equipped != 0
+            if equipped:
+                container.equip(equipment)
+            else:
+                container.unequip(equipment)
+        elif tag == REC_EXPLORED:
+            explored = game.current_map.explored
+            for index in struct.unpack("<%dI" % (len(payload) // 4), payload):
+                explored[index] = 1
+        elif tag == REC_MESSAGE:
+            msg = cursor.string()
+            game.message_history.add(msg, cursor.string())
+    return len(records)
+
+
+# Saves the game every interval seconds (and after taking the stairs) on a background thread
+# capture(compact_levels) copies the game into a savefile.struct_SaveImage, on the game's thread
+# saved(image), if given, is called on the game's thread once that save is on disk
+class obj_Autosave(object):
+    def __init__(self, journal, capture, path=constants.SAVE_FILE, interval=constants.AUTOSAVE_INTERVAL,
+                 compression=constants.SAVE_COMPRESSION, threaded=True, saved=None):
+        self.journal = journal
+        self.capture = capture
+        self.saved = saved
+        self.path = path
+        self.interval = interval
+        self.compression = compression
+        self.last_save = time.time()
+        # a save is being written
+        self.busy = False
+        # the last save that made it to disk, set by the thread
+        self.written = None
+        # and the last one tick() dealt with
+        self.done = None
+        self.saves = 0
+        self.queue = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, name="autosave")
+            self.thread.daemon = True
+            self.thread.start()
+
+    # once a turn: the turn's records to the journal, and a save if it's time
+    def tick(self, game):
+        self.journal.flush()
+        written = self.written
+        if written is not None and written is not self.done:
+            self.journal.truncate(written.journal_seq)
+            if self.saved is not None:
+                self.saved(written)
+            self.done = written
+        if self.busy:
+            return
+        if self.journal.save_due or (self.journal.records and time.time() - self.last_save >= self.interval):
+            self.save(game)
+
+    def save(self, game):
+        self.journal.save_due = False
+        seq = self.journal.new_segment(game.current_entities)
+        # the S record has to be on disk before the save that refers to it
+        self.journal.sync()
+        # the level store only compacts once it's mostly levels taken back out (see obj_LevelStore.flush)
+        image = self.capture(False)
+        image.journal_seq = seq
+        self.last_save = time.time()
+        if self.queue is not None:
+            self.busy = True
+            self.queue.put(image)
+        else:
+            self._write(image)
+
+    def _write(self, image):
+        try:
+            savefile.write_save_file(self.path, image, self.compression)
+        except (IOError, OSError) as e:
+            LOG.warning("autosave failed: %s", e)
+        else:
+            self.written = image
+            self.saves += 1
+
+    def _run(self):
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            self._write(image)
+            self.busy = False
+
+    def _stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    # leaving the game: waits for the save in progress, saves once more (here, with the level store
+    # compacted), and the journal goes
+    def close(self, game):
+        self._stop()
+        seq = self.journal.new_segment(game.current_entities)
+        self.journal.flush()
+        image = self.capture(True)
+        image.journal_seq = seq
+        savefile.write_save_file(self.path, image, self.compression)
+        if self.saved is not None:
+            self.saved(image)
+        self.journal.close(remove=True)
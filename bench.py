@@ -0,0 +1,138 @@
+# coding: utf8
+# Benchmarks for the headless game: turns/sec, map generation, FOV and save/load
+# across map sizes and entity counts. Results are written as JSON so runs can be compared
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import timeit
+
+import constants
+import headless
+import main
+
+# new_game() changes these constants, so remember the defaults
+DEFAULT_MAX_ROOMS = constants.MAX_ROOMS
+
+
+def _best_of(func, repeat):
+    # the fastest run is the least disturbed by whatever else the machine is doing
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _result(name, size, entities, value, unit):
+    return {
+        'benchmark': name,
+        'map_size': size,
+        'entities': entities,
+        'value': value,
+        'unit': unit,
+    }
+
+
+def _rooms_for(size):
+    # keep roughly the same density of rooms as the default 20x20 map
+    return max(DEFAULT_MAX_ROOMS, DEFAULT_MAX_ROOMS * size * size // 400)
+
+
+def bench_mapgen(size, repeat):
+    headless.new_game(size, size, _rooms_for(size))
+    elapsed = _best_of(main.map_create, repeat)
+    return [_result('mapgen', size, 0, elapsed * 1000, 'ms')]
+
+
+def bench_fov(size, repeat):
+    game, player = headless.new_game(size, size, _rooms_for(size))
+
+    build = _best_of(lambda: main.map_make_fov(game.current_map), repeat)
+
+    fov_map = main.map_make_fov(game.current_map)
+    compute = _best_of(lambda: fov_map.compute(player.x, player.y), repeat)
+    return [_result('fov_build', size, 0, build * 1000, 'ms'),
+            _result('fov_compute', size, 0, compute * 1000, 'ms')]
+
+
+def bench_turns(size, entities, turns, seed, render):
+    headless.new_game(size, size, _rooms_for(size), monsters=entities, render=render, seed=seed)
+    player = headless.random_player(random.Random(seed))
+
+    start = timeit.default_timer()
+    played = headless.run(player, turns, render)
+    elapsed = timeit.default_timer() - start
+
+    name = 'turns_rendered' if render else 'turns'
+    results = [_result(name, size, entities, played / elapsed, 'turns/s')]
+    # how many monsters actually took a turn each tick, the rest were asleep
+    scheduler = main.GAME.scheduler
+    if not render and scheduler.ticks:
+        results.append(_result('actors_per_turn', size, entities,
+                               float(scheduler.total_acted) / scheduler.ticks, 'actors'))
+    return results
+
+
+def bench_save_load(size, entities, repeat):
+    headless.new_game(size, size, _rooms_for(size), monsters=entities)
+    handle, path = tempfile.mkstemp(prefix='bench_save')
+    os.close(handle)
+    try:
+        save = _best_of(lambda: main.save_game(path), repeat)
+        load = _best_of(lambda: main.load_game(path), repeat)
+        size_bytes = os.path.getsize(path)
+    finally:
+        os.remove(path)
+    return [_result('save', size, entities, save * 1000, 'ms'),
+            _result('load', size, entities, load * 1000, 'ms'),
+            _result('save_size', size, entities, size_bytes, 'bytes')]
+
+
+def run_all(sizes, entity_counts, turns, repeat, seed, render):
+    results = []
+    for size in sizes:
+        results += bench_mapgen(size, repeat)
+        results += bench_fov(size, repeat)
+        for entities in entity_counts:
+            results += bench_turns(size, entities, turns, seed, False)
+            if render:
+                results += bench_turns(size, entities, turns, seed, True)
+            results += bench_save_load(size, entities, repeat)
+    return results
+
+
+def _int_list(text):
+    return [int(part) for part in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the game without a window")
+    parser.add_argument('--sizes', type=_int_list, default=[20, 50, 100, 200])
+    parser.add_argument('--entities', type=_int_list, default=[0, 100, 1000])
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--render', action='store_true', help="also time turns with the renderer running")
+    parser.add_argument('--out', default='bench_results.json')
+    args = parser.parse_args()
+
+    results = run_all(args.sizes, args.entities, args.turns, args.repeat, args.seed, args.render)
+
+    with open(args.out, 'w') as out_file:
+        json.dump({
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, out_file, indent=4)
+
+    for res in results:
+        print("%-14s size %5d entities %5d: %12.3f %s" % (res['benchmark'], res['map_size'], res['entities'],
+                                                           res['value'], res['unit']))
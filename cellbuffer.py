@@ -0,0 +1,88 @@
+# coding: utf8
+# Every blt.put/blt.color is a call into the BearLibTerminal library, and a full map is thousands of them
+# Instead, the renderer puts what it wants to draw in here, and flush() sends it to the terminal
+# as one puts() per row (or per stretch of a row) with color and composition markup
+# The terminal is passed in, so the same code draws to null_terminal in headless runs
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# stretches of a row at most this far apart are joined with spaces into one puts()
+MAX_GAP = 16
+
+
+def glyph_markup(char, offset=None):
+    if not isinstance(char, string_types):
+        char = unichr(char)
+    # [ and ] start markup, doubling them prints them as they are
+    char = char.replace("[", "[[").replace("]", "]]")
+    if offset is not None:
+        return "[offset=%d,%d]%s" % (offset[0], offset[1], char)
+    return char
+
+
+class obj_CellBuffer(object):
+    def __init__(self):
+        # layer -> y -> x -> list of (color, markup), drawn on top of each other
+        self.layers = {}
+
+    def __len__(self):
+        return sum(len(row) for rows in self.layers.values() for row in rows.values())
+
+    def put(self, layer, x, y, char, color="white", offset=None):
+        row = self.layers.setdefault(layer, {}).setdefault(y, {})
+        glyphs = row.get(x)
+        if glyphs is None:
+            glyphs = row[x] = []
+        glyphs.append((color, glyph_markup(char, offset)))
+
+    def clear(self):
+        self.layers = {}
+
+    # fill_gaps: the layer was cleared, so the spaces between the cells of a row can be printed over
+    # otherwise every stretch of neighbouring cells is printed on its own
+    # returns how many calls went to the terminal
+    def flush(self, terminal, fill_gaps=True):
+        calls = 0
+        max_gap = MAX_GAP if fill_gaps else 0
+        for layer in sorted(self.layers):
+            rows = self.layers[layer]
+            if not rows:
+                continue
+            terminal.layer(layer)
+            calls += 1
+            for y in sorted(rows):
+                row = rows[y]
+                parts = []
+                start = end = None
+                color = None
+                for x in sorted(row):
+                    if start is not None and x - end > max_gap:
+                        terminal.puts(start, y, "".join(parts))
+                        calls += 1
+                        parts = []
+                        start = None
+                    if start is None:
+                        start = end = x
+                        color = None
+                    parts.append(" " * (x - end))
+                    for i, (glyph_color, markup) in enumerate(row[x]):
+                        if i > 0:
+                            # draw on top of the previous glyph instead of moving on
+                            parts.append("[+]")
+                        if glyph_color != color:
+                            parts.append("[color=" + glyph_color + "]")
+                            color = glyph_color
+                        parts.append(markup)
+                    end = x + 1
+                if start is not None:
+                    terminal.puts(start, y, "".join(parts))
+                    calls += 1
+        self.layers = {}
+        return calls
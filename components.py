@@ -0,0 +1,159 @@
+# coding: utf8
+# Storage for entities and their components
+# obj_Entity and the com_* classes (main.py) used to be plain objects, every one with its own __dict__
+# Now each field is a column: one array per number/flag (array('i') etc.), one list per anything else,
+# with a row per entity or component. The objects themselves are small __slots__ facades that only know their row,
+# so entity.creature.hp -= 5 keeps working, and a pass over all the creatures can read the columns directly
+# A row is given back when its facade is garbage collected. That goes through a weakref callback, which
+# (unlike __del__) also works for the entity <-> component reference cycles on Python 2
+import weakref
+from array import array
+from itertools import compress
+from operator import itemgetter
+
+
+# a weak reference that remembers which row it is for
+class _RowRef(weakref.ref):
+    __slots__ = ("row",)
+
+    def __new__(cls, facade, callback, row):
+        self = weakref.ref.__new__(cls, facade, callback)
+        self.row = row
+        return self
+
+    def __init__(self, facade, callback, row):
+        super(_RowRef, self).__init__(facade, callback)
+
+
+class obj_ComponentTable(object):
+    # columns: (field, array typecode, default), objects: fields that hold anything
+    def __init__(self, name, columns=(), objects=()):
+        self.name = name
+        self.columns = {}
+        self.defaults = {}
+        for field, typecode, default in columns:
+            self.columns[field] = array(typecode)
+            self.defaults[field] = default
+        self.objects = dict((field, []) for field in objects)
+        # the row of the entity each component is on (set by obj_Entity), -1 for none
+        self.owners = array('i')
+        # weak references to the facades, None for free rows
+        self.refs = []
+        self.free = []
+        # one bound method for all the rows
+        self._callback = self._released
+
+    def __len__(self):
+        return len(self.refs) - len(self.free)
+
+    def allocate(self, facade):
+        if self.free:
+            row = self.free.pop()
+            for field, values in self.columns.items():
+                values[row] = self.defaults[field]
+            self.owners[row] = -1
+        else:
+            row = len(self.refs)
+            for field, values in self.columns.items():
+                values.append(self.defaults[field])
+            for values in self.objects.values():
+                values.append(None)
+            self.owners.append(-1)
+            self.refs.append(None)
+        self.refs[row] = _RowRef(facade, self._callback, row)
+        return row
+
+    def _released(self, ref):
+        row = ref.row
+        self.refs[row] = None
+        # don't keep names, inventories etc. alive
+        for values in self.objects.values():
+            values[row] = None
+        self.owners[row] = -1
+        self.free.append(row)
+
+    # the facades that are still around
+    def facades(self):
+        for ref in self.refs:
+            if ref is not None:
+                facade = ref()
+                if facade is not None:
+                    yield facade
+
+    def column(self, field):
+        return self.columns[field]
+
+    # the values of field for many rows at once, the indexing is done by itemgetter in C
+    def gather(self, field, rows):
+        values = self.columns[field]
+        if len(rows) < 2:
+            return [values[row] for row in rows]
+        return itemgetter(*rows)(values)
+
+
+# Class attributes for the facades, e.g. hp = field(table, 'hp')
+# The column is looked up once, here, so an access is one property call and one index
+def field(table, name):
+    if name in table.columns:
+        values = table.columns[name]
+    else:
+        values = table.objects[name]
+
+    def get(self):
+        return values[self.row]
+
+    def set(self, value):
+        values[self.row] = value
+
+    return property(get, set)
+
+
+# the same, for a column of 0/1 that reads as False/True
+def flag(table, name):
+    values = table.columns[name]
+
+    def get(self):
+        return values[self.row] != 0
+
+    def set(self, value):
+        values[self.row] = 1 if value else 0
+
+    return property(get, set)
+
+
+class obj_EntityStore(object):
+    def __init__(self):
+        self.tables = {}
+        # positions, the rest of an entity is its components
+        self.entities = self.add_table('entity', (('x', 'i', 0), ('y', 'i', 0)))
+
+    def add_table(self, name, columns=(), objects=()):
+        table = self.tables[name] = obj_ComponentTable(name, columns, objects)
+        return table
+
+    def table(self, name):
+        return self.tables[name]
+
+    # Every entity with component name (e.g. 'ai'), as (entity row, component row) pairs
+    # Straight from the owner column, without an entity list or a single facade,
+    # and only the rows where the flag column where is set, if given (e.g. where='chasing')
+    def with_component(self, name, where=None):
+        table = self.tables[name]
+        owners = table.owners
+        rows = range(len(owners))
+        if where is not None:
+            rows = compress(rows, table.columns[where])
+        return [(owners[row], row) for row in rows if owners[row] >= 0]
+
+    # x and y of many entities, read from the columns instead of through every entity's properties
+    def positions(self, entities):
+        rows = [ent.row for ent in entities]
+        return self.entities.gather('x', rows), self.entities.gather('y', rows)
+
+    # how many rows are in use, per table
+    def counts(self):
+        return dict((name, len(table)) for name, table in self.tables.items())
+
+
+# the store main.py's entities and components live in
+STORE = obj_EntityStore()
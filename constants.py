@@ -1,5 +1,9 @@
 import libtcodpy as libtcod
 
+# Window size, in cells
+SCREEN_WIDTH = 160
+SCREEN_HEIGHT = 45
+
 # Map size
 MAP_HEIGHT = 20
 MAP_WIDTH = 20
@@ -13,14 +17,79 @@ TILE_WIDTH = 8
 ROOM_MAX_SIZE = 6
 ROOM_MIN_SIZE = 4
 MAX_ROOMS = 4
+# which generator makes the levels: 'rooms' (the tutorial one), 'bsp' or 'caves' (see dungeon.py)
+MAP_ALGORITHM = 'rooms'
+# caves start as this many percent of wall, and are smoothed this many times
+CAVE_FILL = 45
+CAVE_STEPS = 4
+# all the random numbers of a game come from this (see rng.py), None picks a new seed for each game
+GAME_SEED = None
+# how many levels to make ahead in the background, and how many processes to make them in
+PREGEN_LEVELS = 2
+PREGEN_PROCESSES = 1
 
 #FOV
 FOV_ALGO = libtcod.FOV_BASIC
 FOV_LIGHT_WALLS = True
 LIGHT_RADIUS = 4
+# monsters that saw the player keep chasing them until they're this far away
+CHASE_DISTANCE = 12
+
+# turns: an action takes ACTION_COST time at NORMAL_SPEED, a creature twice as fast takes half as long
+NORMAL_SPEED = 100
+ACTION_COST = 100
+# monsters further than this from the player fall asleep until the player comes close or something makes noise
+WAKE_RADIUS = 16
+# how far a fight can be heard
+NOISE_RADIUS = 8
+
+# how many FOV results the visibility service remembers
+VISIBILITY_CACHE_SIZE = 1024
 
 NUM_MESSAGES = 4
+# how many messages the log keeps; older ones go to MESSAGE_SPILL_FILE if set, otherwise they're dropped
+MESSAGE_LOG_SIZE = 100
+MESSAGE_SPILL_FILE = None
+
+# main loop: frame rate cap, and how long to sleep waiting for input when nothing is animating (seconds)
+TARGET_FPS = 30
+IDLE_TIMEOUT = 1.0
+
+# only redraw the parts of the screen that changed since the last frame
+INCREMENTAL_RENDER = True
+# the camera follows the player once they get this many tiles close to the edge of the screen
+CAMERA_MARGIN = 4
+# screen positions are kept for this many map sizes (see projection)
+PROJECTION_CACHE_SIZE = 4
+
+# save file, and how to compress it ('zlib', 'lzma' on Python 3, or None)
+SAVE_FILE = "savegame.dat"
+SAVE_COMPRESSION = "zlib"
+# levels the player left are kept compressed, the last LEVEL_CACHE_SIZE in memory and the rest in this file
+LEVEL_STORE_FILE = "levels.dat"
+LEVEL_CACHE_SIZE = 4
+# autosave (autosave.py): what happens is journaled as it happens, and the save is rewritten in the background
+# every AUTOSAVE_INTERVAL seconds (and after taking the stairs); after a crash the journal is replayed on top of it
+AUTOSAVE = True
+AUTOSAVE_INTERVAL = 30
+JOURNAL_FILE = "savegame.journal"
 
 #SPELLS
 LIGHTNING_RANGE = 4
-LIGHTNING_DAMAGE = 10
\ No newline at end of file
+LIGHTNING_DAMAGE = 10
+
+# logging of the game's internals, see gamelog.py
+# levels: 'debug', 'info', 'warning', 'error', 'off'
+LOG_LEVEL = 'warning'
+# per category, e.g. {'combat': 'debug'}
+LOG_CATEGORY_LEVELS = {}
+# None logs to stderr, otherwise to this file from a background thread
+LOG_FILE = None
+LOG_BUFFER_SIZE = 65536
+
+# profiling (F11 toggles it and the overlay, F12 writes PROFILE_FILE)
+# percentiles are over this many recent samples of each timer
+PROFILE_HISTORY = 300
+PROFILE_FILE = "profile.json"
+# how often the overlay is refreshed, in seconds
+PROFILE_OVERLAY_INTERVAL = 0.5
@@ -0,0 +1,339 @@
+# coding: utf8
+# Dungeon generators
+# Every algorithm is a function (randint, width, height, max_rooms) -> (struct_TileGrid, rooms)
+# and is registered in GENERATORS, so map_create (and levelgen) can pick one by name
+# The player starts in the middle of the first room, the stairs go in the middle of the last one
+# Everything is carved a whole rectangle at a time (struct_TileGrid.carve_rect), never tile by tile
+import binascii
+import random
+from collections import deque
+
+import constants
+from tilegrid import struct_TileGrid
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+class Rect(object):
+    # a rectangle on the map. used to characterize a room.
+    def __init__(self, x, y, w, h):
+        self.x1 = x
+        self.y1 = y
+        self.x2 = x + w
+        self.y2 = y + h
+
+    def center(self):
+        center_x = (self.x1 + self.x2) // 2
+        center_y = (self.y1 + self.y2) // 2
+        return (center_x, center_y)
+
+    def intersect(self, other):
+        # returns true if this rectangle intersects with another one
+        return (self.x1 <= other.x2 and self.x2 >= other.x1 and
+                self.y1 <= other.y2 and self.y2 >= other.y1)
+
+
+def create_room(room, new_map):
+    # make the tiles in the rectangle passable (the outer edge stays as wall)
+    new_map.carve_rect(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
+
+
+def create_h_tunnel(x1, x2, y, new_map):
+    # horizontal tunnel. min() and max() are used in case x1>x2
+    new_map.carve_rect(min(x1, x2), y, max(x1, x2) + 1, y + 1)
+
+
+def create_v_tunnel(y1, y2, x, new_map):
+    # vertical tunnel
+    new_map.carve_rect(x, min(y1, y2), x + 1, max(y1, y2) + 1)
+
+
+# an L-shaped tunnel between two points, which way round is a coin toss
+def connect(randint, new_map, x1, y1, x2, y2):
+    if randint(0, 1) == 1:
+        # first move horizontally, then vertically
+        create_h_tunnel(x1, x2, y1, new_map)
+        create_v_tunnel(y1, y2, x2, new_map)
+    else:
+        # first move vertically, then horizontally
+        create_v_tunnel(y1, y2, x1, new_map)
+        create_h_tunnel(x1, x2, y2, new_map)
+
+
+# Accepted rooms, bucketed by area, so a new room is only checked against its neighbours
+# instead of against every room so far
+# Two rooms that intersect share at least one cell, so they share the bucket of that cell
+class obj_RoomIndex(object):
+    def __init__(self, bucket=constants.ROOM_MAX_SIZE + 1):
+        self.bucket = bucket
+        self.buckets = {}
+
+    def _keys(self, room):
+        size = self.bucket
+        for bx in xrange(room.x1 // size, room.x2 // size + 1):
+            for by in xrange(room.y1 // size, room.y2 // size + 1):
+                yield bx, by
+
+    def add(self, room):
+        for key in self._keys(room):
+            self.buckets.setdefault(key, []).append(room)
+
+    def intersects(self, room):
+        for key in self._keys(room):
+            for other in self.buckets.get(key, ()):
+                if room.intersect(other):
+                    return True
+        return False
+
+
+def place_stairs(new_map, rooms):
+    stairs_x, stairs_y = rooms[-1].center()
+    new_map.set_stairs(stairs_x, stairs_y)
+
+
+# The original tutorial generator: random rooms that don't overlap, each joined to the one before it
+# Makes the same maps as before for the same random numbers
+def generate_rooms(randint, width, height, max_rooms):
+    new_map = struct_TileGrid(width, height)
+    rooms = []
+    placed = obj_RoomIndex()
+
+    for r in xrange(max_rooms):
+        # random width and height
+        w = randint(constants.ROOM_MIN_SIZE, constants.ROOM_MAX_SIZE)
+        h = randint(constants.ROOM_MIN_SIZE, constants.ROOM_MAX_SIZE)
+        # random position without going out of the boundaries of the map
+        x = randint(0, width - w - 1)
+        y = randint(0, height - h - 1)
+
+        new_room = Rect(x, y, w, h)
+        if placed.intersects(new_room):
+            continue
+
+        # "paint" it to the map's tiles
+        create_room(new_room, new_map)
+        if rooms:
+            # all rooms after the first: connect it to the previous room with a tunnel
+            prev_x, prev_y = rooms[-1].center()
+            new_x, new_y = new_room.center()
+            connect(randint, new_map, prev_x, prev_y, new_x, new_y)
+
+        rooms.append(new_room)
+        placed.add(new_room)
+
+    place_stairs(new_map, rooms)
+    return new_map, rooms
+
+
+# Binary space partitioning: the map is cut in two, the halves in two again and so on (breadth first,
+# so the leaves end up about the same size) until there are max_rooms leaves or they're too small to cut
+# Every leaf gets a room, and every cut is bridged by a tunnel between a room on each side,
+# so the tunnels stay short and the rooms never overlap
+def generate_bsp(randint, width, height, max_rooms):
+    new_map = struct_TileGrid(width, height)
+    # a leaf has to fit the biggest room plus a wall
+    min_leaf = constants.ROOM_MAX_SIZE + 1
+
+    # (x, y, w, h, first child) per node; children are always next to each other
+    nodes = [(0, 0, width, height, None)]
+    queue = deque([0])
+    leaves = 1
+    while queue and leaves < max_rooms:
+        node = queue.popleft()
+        x, y, w, h, child = nodes[node]
+        # cut across the longer side
+        if w >= h and w >= 2 * min_leaf:
+            cut = randint(min_leaf, w - min_leaf)
+            halves = ((x, y, cut, h), (x + cut, y, w - cut, h))
+        elif h >= 2 * min_leaf:
+            cut = randint(min_leaf, h - min_leaf)
+            halves = ((x, y, w, cut), (x, y + cut, w, h - cut))
+        elif w >= 2 * min_leaf:
+            cut = randint(min_leaf, w - min_leaf)
+            halves = ((x, y, cut, h), (x + cut, y, w - cut, h))
+        else:
+            continue
+        nodes[node] = (x, y, w, h, len(nodes))
+        for half in halves:
+            queue.append(len(nodes))
+            nodes.append(half + (None,))
+        leaves += 1
+
+    # a room in every leaf and a tunnel across every cut, bottom up
+    rooms = []
+    # node -> the room that tunnels into that part of the tree come to
+    entrance = {}
+    for node in xrange(len(nodes) - 1, -1, -1):
+        x, y, w, h, child = nodes[node]
+        if child is None:
+            room_w = min(randint(constants.ROOM_MIN_SIZE, constants.ROOM_MAX_SIZE), w - 1)
+            room_h = min(randint(constants.ROOM_MIN_SIZE, constants.ROOM_MAX_SIZE), h - 1)
+            room = Rect(randint(x, x + w - room_w - 1), randint(y, y + h - room_h - 1), room_w, room_h)
+            create_room(room, new_map)
+            entrance[node] = room
+        else:
+            # children were numbered after their parent, so they're done already
+            first, second = entrance[child], entrance[child + 1]
+            first_x, first_y = first.center()
+            second_x, second_y = second.center()
+            connect(randint, new_map, first_x, first_y, second_x, second_y)
+            entrance[node] = first
+
+    # leaves in tree order, so the first and the last room are far apart
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        child = nodes[node][4]
+        if child is None:
+            rooms.append(entrance[node])
+        else:
+            stack.extend((child + 1, child))
+
+    place_stairs(new_map, rooms)
+    return new_map, rooms
+
+
+# 1 where the byte is a wall (1), as the characters of a binary number
+_WALL_DIGITS = bytes(bytearray(b"0" + b"1" * 255))
+_DIGIT_BYTES = bytes(bytearray([0] * 48 + [0, 1] + [0] * 206))
+
+
+def _random_bytes(rand, count):
+    if count == 0:
+        return b""
+    return binascii.unhexlify("%0*x" % (count * 2, rand.getrandbits(count * 8)))
+
+
+# Cellular automaton caves: start from random noise, then a few times over, a cell becomes wall
+# if at least 5 of the 9 cells around it (itself included, off the map counts as wall) are walls
+# Rows are worked on as Python ints, one bit per cell, so a whole row is a handful of big int operations
+# Only the biggest cave is kept; the player starts somewhere in it and the stairs are as far away as it gets
+def generate_caves(randint, width, height, max_rooms):
+    new_map = struct_TileGrid(width, height)
+    rand = random.Random(randint(0, 0x7fffffff))
+    # CAVE_FILL percent of noise is wall
+    threshold = constants.CAVE_FILL * 256 // 100
+    to_wall = bytes(bytearray([1 if value < threshold else 0 for value in xrange(256)]))
+
+    # row y, bit x = wall at (x, y)
+    full = (1 << width) - 1
+    rows = []
+    for y in xrange(height):
+        noise = bytearray(_random_bytes(rand, width).translate(to_wall))
+        rows.append(_row_from_bytes(noise))
+
+    for step in xrange(constants.CAVE_STEPS):
+        rows = [_cave_step(rows[y - 1] if y > 0 else full, rows[y], rows[y + 1] if y < height - 1 else full, width)
+                for y in xrange(height)]
+
+    # back into the map, with a wall all around so the flood fill never leaves it
+    data = new_map.block_path
+    for y in xrange(1, height - 1):
+        line = _row_to_bytes(rows[y] | 1 | (1 << (width - 1)), width)
+        data[y:(width - 1) * height + y + 1:height] = line
+
+    start, stairs = _keep_biggest_cave(new_map, rand)
+    if start is None:
+        # nothing but rock, carve a room so there's somewhere to stand
+        return generate_rooms(randint, width, height, 1)
+
+    rooms = [Rect(start[0] - 1, start[1] - 1, 2, 2), Rect(stairs[0] - 1, stairs[1] - 1, 2, 2)]
+    new_map.set_stairs(*stairs)
+    return new_map, rooms
+
+
+def _row_from_bytes(cells):
+    # bit x is cell x, so the digits are written from the last cell to the first
+    return int(bytes(cells.translate(_WALL_DIGITS))[::-1], 2)
+
+
+def _row_to_bytes(bits, width):
+    digits = ("{0:0%db}" % width).format(bits)[::-1].encode("ascii")
+    return bytearray(digits.translate(_DIGIT_BYTES))
+
+
+def _cave_step(above, row, below, width):
+    full = (1 << width) - 1
+    top = 1 << (width - 1)
+    # the 9 neighbours of every cell at once; past the left and right edges is wall
+    neighbours = []
+    for line in (above, row, below):
+        neighbours.append(((line << 1) | 1) & full)
+        neighbours.append(line)
+        neighbours.append((line >> 1) | top)
+
+    # count them with a 4 bit counter per cell, one int per bit
+    b0 = b1 = b2 = b3 = 0
+    for bits in neighbours:
+        carry = b0 & bits
+        b0 ^= bits
+        carry2 = b1 & carry
+        b1 ^= carry
+        carry3 = b2 & carry2
+        b2 ^= carry2
+        b3 |= carry3
+    # count >= 5
+    return (b3 | (b2 & (b1 | b0))) & full
+
+
+# fills every cave but the biggest one, returns a random cell of it and the cell furthest from that
+def _keep_biggest_cave(new_map, rand):
+    height = new_map.height
+    data = new_map.block_path
+    steps = (1, -1, height, -height)
+
+    seen = bytearray(len(data))
+    biggest = []
+    for index in new_map.free_indices():
+        if seen[index]:
+            continue
+        seen[index] = 1
+        cave = [index]
+        for cell in cave:
+            for step in steps:
+                other = cell + step
+                if not data[other] and not seen[other]:
+                    seen[other] = 1
+                    cave.append(other)
+        if len(cave) > len(biggest):
+            for cell in biggest:
+                data[cell] = 1
+            biggest = cave
+        else:
+            for cell in cave:
+                data[cell] = 1
+
+    if not biggest:
+        return None, None
+
+    start = biggest[rand.randrange(len(biggest))]
+    # breadth first from the start, the last cell reached is the furthest
+    seen = bytearray(len(data))
+    seen[start] = 1
+    queue = deque([start])
+    furthest = start
+    while queue:
+        furthest = cell = queue.popleft()
+        for step in steps:
+            other = cell + step
+            if not data[other] and not seen[other]:
+                seen[other] = 1
+                queue.append(other)
+    return new_map.coords(start), new_map.coords(furthest)
+
+
+# name -> generator
+GENERATORS = {
+    'rooms': generate_rooms,
+    'bsp': generate_bsp,
+    'caves': generate_caves,
+}
+
+
+def generate(randint, width, height, max_rooms, algorithm=None):
+    if algorithm is None:
+        algorithm = constants.MAP_ALGORITHM
+    return GENERATORS[algorithm](randint, width, height, max_rooms)
@@ -0,0 +1,94 @@
+# coding: utf8
+import itertools
+
+import libtcodpy as libtcod
+
+import constants
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+_NOT_TABLE = bytes(bytearray([1] + [0] * 255))
+_BOOL_TABLE = bytes(bytearray([0] + [1] * 255))
+
+
+# libtcod FOV map kept in sync with a struct_TileGrid
+# Setting cells one by one through the binding is slow, so building starts from map_clear()
+# with the most common value and then only sets the cells that differ
+# After that the map listens to the grid and only updates the cells that changed
+class obj_FovMap(object):
+    def __init__(self, grid, transparent=None, walkable=None):
+        self.grid = grid
+        self.width = grid.width
+        self.height = grid.height
+        self.fov = libtcod.map_new(grid.width, grid.height)
+        # what we last computed, so it can be saved and restored
+        self.origin = None
+
+        if transparent is None:
+            # a tile you can walk through is also one you can see through
+            transparent = grid.walkable_mask()
+        if walkable is None:
+            walkable = grid.walkable_mask()
+        self.build(transparent, walkable)
+
+        grid.listeners.append(self.tiles_changed)
+
+    def build(self, transparent, walkable):
+        self.transparent = bytearray(transparent)
+        self.walkable = bytearray(walkable)
+
+        # clear to whatever most cells are
+        size = len(self.transparent)
+        open_cells = self.transparent.count(b"\x01")
+        clear_value = open_cells * 2 > size
+        libtcod.map_clear(self.fov, clear_value, clear_value)
+
+        differ_table = _NOT_TABLE if clear_value else _BOOL_TABLE
+        differ = set(itertools.compress(xrange(size), bytearray(bytes(self.transparent).translate(differ_table))))
+        differ.update(itertools.compress(xrange(size), bytearray(bytes(self.walkable).translate(differ_table))))
+
+        height = self.height
+        for index in differ:
+            x, y = divmod(index, height)
+            libtcod.map_set_properties(self.fov, x, y, self.transparent[index] != 0, self.walkable[index] != 0)
+
+    def detach(self):
+        if self.tiles_changed in self.grid.listeners:
+            self.grid.listeners.remove(self.tiles_changed)
+
+    # called by the grid when tiles get carved or blocked
+    def tiles_changed(self, indices):
+        block_path = self.grid.block_path
+        for index in indices:
+            is_open = 0 if block_path[index] else 1
+            self.set_properties_index(index, is_open, is_open)
+
+    def set_properties(self, x, y, transparent, walkable):
+        self.set_properties_index(x * self.height + y, transparent, walkable)
+
+    def set_properties_index(self, index, transparent, walkable):
+        transparent = 1 if transparent else 0
+        walkable = 1 if walkable else 0
+        if self.transparent[index] == transparent and self.walkable[index] == walkable:
+            return
+        self.transparent[index] = transparent
+        self.walkable[index] = walkable
+        x, y = divmod(index, self.height)
+        libtcod.map_set_properties(self.fov, x, y, transparent != 0, walkable != 0)
+
+    def compute(self, x, y, radius=constants.LIGHT_RADIUS, light_walls=constants.FOV_LIGHT_WALLS,
+                algo=constants.FOV_ALGO):
+        self.origin = (x, y, radius, light_walls, algo)
+        libtcod.map_compute_fov(self.fov, x, y, radius, light_walls, algo)
+
+    def is_in_fov(self, x, y):
+        return libtcod.map_is_in_fov(self.fov, x, y)
+
+    def is_transparent(self, x, y):
+        return self.transparent[x * self.height + y] != 0
+
+    def is_walkable(self, x, y):
+        return self.walkable[x * self.height + y] != 0
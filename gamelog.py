@@ -0,0 +1,164 @@
+# coding: utf8
+# Logging for the game's internals (dice rolls, map generation, AI...)
+# Every category has its own level, and a disabled message costs one attribute check:
+# the message is only formatted (with % and the args) when it is actually written,
+# and with a file sink that happens on a background thread
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+import constants
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    'off': OFF,
+}
+LEVEL_NAMES = dict((value, name.upper()) for name, value in LEVELS.items())
+
+def level_value(level):
+    if isinstance(level, int):
+        return level
+    return LEVELS[level.lower()]
+
+
+def format_event(event):
+    created, level, category, msg, args = event
+    if args:
+        msg = msg % args
+    return "%.3f %s [%s] %s\n" % (created, LEVEL_NAMES.get(level, str(level)), category, msg)
+
+
+# writes right away, for the console
+class obj_StreamSink(object):
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def emit(self, event):
+        (self.stream or sys.stderr).write(format_event(event))
+
+    def close(self):
+        pass
+
+
+# Events are queued and written by a background thread through a buffered file,
+# so the game never waits for the disk
+class obj_FileSink(object):
+    def __init__(self, path, threaded=True, buffer_size=constants.LOG_BUFFER_SIZE):
+        self.file = open(path, 'a', buffer_size)
+        self.queue = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, name="gamelog")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def emit(self, event):
+        if self.queue is not None:
+            self.queue.put(event)
+        else:
+            self.file.write(format_event(event))
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            # the file is buffered, so this only hits the disk now and then
+            self.file.write(format_event(event))
+        self.file.flush()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.file.close()
+
+
+class obj_Logger(object):
+    def __init__(self, category, level, sink):
+        self.category = category
+        self.sink = sink
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level_value(level)
+        # checked by callers that would do extra work just to build the message
+        self.debug_enabled = self.level <= DEBUG
+        self.info_enabled = self.level <= INFO
+
+    def log(self, level, msg, *args):
+        if level >= self.level:
+            self.sink.emit((time.time(), level, self.category, msg, args))
+
+    def debug(self, msg, *args):
+        if self.debug_enabled:
+            self.sink.emit((time.time(), DEBUG, self.category, msg, args))
+
+    def info(self, msg, *args):
+        if self.info_enabled:
+            self.sink.emit((time.time(), INFO, self.category, msg, args))
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+
+_sink = obj_StreamSink()
+_loggers = {}
+
+
+def _category_level(category):
+    return constants.LOG_CATEGORY_LEVELS.get(category, constants.LOG_LEVEL)
+
+
+def get_logger(category='general'):
+    logger = _loggers.get(category)
+    if logger is None:
+        logger = _loggers[category] = obj_Logger(category, _category_level(category), _sink)
+    return logger
+
+
+# level applies to every category, unless categories (category -> level) says otherwise
+# path sends everything to a file instead of stderr
+def configure(level=None, categories=None, path=None, threaded=True):
+    global _sink
+    if level is not None:
+        constants.LOG_LEVEL = level
+    if categories is not None:
+        constants.LOG_CATEGORY_LEVELS = dict(categories)
+
+    if path is not None:
+        _sink.close()
+        _sink = obj_FileSink(path, threaded)
+
+    for category, logger in _loggers.items():
+        logger.sink = _sink
+        logger.set_level(_category_level(category))
+
+
+# writes out whatever is still queued
+def shutdown():
+    global _sink
+    _sink.close()
+    _sink = obj_StreamSink()
+    for logger in _loggers.values():
+        logger.sink = _sink
@@ -0,0 +1,100 @@
+# coding: utf8
+import time
+from collections import deque
+
+import constants
+
+# how often we check for input while sleeping, in seconds
+POLL_INTERVAL = 0.01
+
+
+# Keeps render frames to the target frame rate and keeps track of how long frames and turns take
+# Simulation ticks (player actions and the AI turns that follow) are counted separately from frames
+class obj_FrameClock(object):
+    def __init__(self, target_fps=constants.TARGET_FPS, history=120):
+        self.frame_interval = 1.0 / target_fps
+        self.last_frame = None
+        # set this while something is animating, so that we keep drawing at the target frame rate
+        self.animating = False
+
+        self.frames = 0
+        self.skipped_frames = 0
+        self.ticks = 0
+        self.frame_times = deque(maxlen=history)
+        self.tick_times = deque(maxlen=history)
+        self.idle_time = 0.0
+        self.started = time.time()
+
+        self._frame_start = None
+        self._tick_start = None
+
+    def frame_due(self):
+        return self.last_frame is None or time.time() - self.last_frame >= self.frame_interval
+
+    def time_to_next_frame(self):
+        if self.last_frame is None:
+            return 0.0
+        return max(0.0, self.last_frame + self.frame_interval - time.time())
+
+    def begin_frame(self):
+        self._frame_start = time.time()
+
+    # drew is False if the renderer had nothing to do
+    def end_frame(self, drew):
+        now = time.time()
+        self.last_frame = now
+        if drew:
+            self.frames += 1
+            self.frame_times.append(now - self._frame_start)
+        else:
+            self.skipped_frames += 1
+
+    def begin_tick(self):
+        self._tick_start = time.time()
+
+    def end_tick(self):
+        self.ticks += 1
+        self.tick_times.append(time.time() - self._tick_start)
+
+    # how long to wait for input before doing anything else
+    def wait_timeout(self):
+        if self.animating:
+            return self.time_to_next_frame()
+        return constants.IDLE_TIMEOUT
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'frames': self.frames,
+            'skipped_frames': self.skipped_frames,
+            'ticks': self.ticks,
+            'fps': self.frames / elapsed,
+            'avg_frame_ms': _average(self.frame_times) * 1000,
+            'max_frame_ms': max(self.frame_times or [0]) * 1000,
+            'avg_tick_ms': _average(self.tick_times) * 1000,
+            'max_tick_ms': max(self.tick_times or [0]) * 1000,
+            'idle_ratio': self.idle_time / elapsed,
+        }
+
+
+def _average(values):
+    if not values:
+        return 0.0
+    return sum(values) / float(len(values))
+
+
+# BearLibTerminal only has a fully blocking read(), so we sleep in short slices until input arrives
+# returns True if there is input waiting
+def wait_for_input(terminal, timeout, clock=None):
+    start = time.time()
+    deadline = start + timeout
+    try:
+        while not terminal.has_input():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            terminal.delay(int(min(remaining, POLL_INTERVAL) * 1000) or 1)
+        return True
+    finally:
+        if clock is not None:
+            clock.idle_time += time.time() - start
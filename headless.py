@@ -0,0 +1,124 @@
+# coding: utf8
+# Running the game without a window, for benchmarks and automated testing
+# The game logic in main.py stays the same: we only swap the terminal for null_terminal
+# and feed keys to game_handle_keys() from a scripted or random player
+import argparse
+import random
+
+import null_terminal
+import constants
+import gamelog
+import main
+import renderer
+from profiler import PROFILER
+from tilegrid import STAIRS_DOWN
+
+# what a scripted player can do, as (key, shift)
+ACTIONS = {
+    'up': (null_terminal.TK_UP, False),
+    'down': (null_terminal.TK_DOWN, False),
+    'left': (null_terminal.TK_LEFT, False),
+    'right': (null_terminal.TK_RIGHT, False),
+    'descend': (null_terminal.TK_PERIOD, True),
+    'ascend': (null_terminal.TK_COMMA, True),
+}
+
+MOVES = ('up', 'down', 'left', 'right')
+
+
+def use_null_backend():
+    main.blt = null_terminal
+    renderer.set_backend(null_terminal)
+
+
+def new_game(map_width=None, map_height=None, max_rooms=None, monsters=0, render=False, seed=None):
+    use_null_backend()
+    # same seed, same dungeon
+    constants.GAME_SEED = seed
+    if map_width is not None:
+        constants.MAP_WIDTH = map_width
+    if map_height is not None:
+        constants.MAP_HEIGHT = map_height
+    if max_rooms is not None:
+        constants.MAX_ROOMS = max_rooms
+
+    main.MAP_RENDERER = renderer.obj_MapRenderer() if render else None
+    main.GAME, main.PLAYER, main.FOV_CALCULATE = main.start_new_game()
+
+    # extra monsters on top of the usual ones
+    for x, y in main.random_free_tiles(main.GAME, monsters):
+        main.GAME.add_entity(main.NPC_wrapper(0xE000, "kobold", x, y))
+
+    main.map_calculate_fov()
+    if main.MAP_RENDERER is not None:
+        main.GAME.entity_index.listener = main.MAP_RENDERER.entity_cell_changed
+
+    return main.GAME, main.PLAYER
+
+
+# players are just iterables of action names
+def random_player(rng=None):
+    if rng is None:
+        rng = random.Random()
+    while True:
+        # take the stairs when standing on them, otherwise walk in a random direction
+        if main.GAME.current_map.stairs_at(main.PLAYER.x, main.PLAYER.y) == STAIRS_DOWN:
+            yield 'descend'
+        else:
+            yield rng.choice(MOVES)
+
+
+def scripted_player(actions, repeat=True):
+    while True:
+        for action in actions:
+            yield action
+        if not repeat:
+            return
+
+
+# returns the number of turns played
+def run(player, turns, render=False):
+    played = 0
+    for action in player:
+        if played >= turns:
+            break
+        key, shift = ACTIONS[action]
+        null_terminal.push_key(key, shift)
+        player_action = main.game_handle_keys()
+        main.game_process_turn(player_action)
+        if render:
+            main.draw_game()
+        played += 1
+    return played
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the game without a window")
+    parser.add_argument('--turns', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--size', type=int, default=None, help="map width and height")
+    parser.add_argument('--monsters', type=int, default=0)
+    parser.add_argument('--render', action='store_true', help="also run the renderer")
+    parser.add_argument('--script', default=None, help="comma separated actions, e.g. up,up,left,descend")
+    parser.add_argument('--log-level', default=None, help="debug, info, warning, error or off")
+    parser.add_argument('--log-file', default=None)
+    parser.add_argument('--profile', default=None, help="time the game's subsystems and write the profile to this file")
+    args = parser.parse_args()
+
+    gamelog.configure(args.log_level, path=args.log_file)
+
+    new_game(args.size, args.size, monsters=args.monsters, render=args.render, seed=args.seed)
+    if args.script:
+        player = scripted_player(args.script.split(','))
+    else:
+        player = random_player(random.Random(args.seed))
+
+    if args.profile:
+        PROFILER.toggle()
+    played = run(player, args.turns, args.render)
+    if args.profile:
+        PROFILER.dump(args.profile)
+    print("Played " + str(played) + " turns, player at " + str((main.PLAYER.x, main.PLAYER.y)) +
+          ", " + str(len(main.GAME.current_entities)) + " entities on the level, " +
+          str(len(main.GAME.scheduler.dormant)) + " of " + str(len(main.GAME.scheduler)) + " monsters asleep")
+    gamelog.shutdown()
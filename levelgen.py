@@ -0,0 +1,166 @@
+# coding: utf8
+# Making levels ahead of time
+# Levels come from a seed, so the same game seed always gives the same dungeon,
+# no matter which process made a level or in which order
+# A finished level is a small picklable payload (packed tiles, rooms, what to spawn where)
+# that main.py turns into a map when the player takes the stairs
+import argparse
+import multiprocessing
+import random
+import timeit
+
+import constants
+import dungeon
+import savefile
+from rng import derive_seed
+from tilegrid import struct_TileGrid, STAIRS_UP
+
+# what gets spawned on every level, see main.SPAWNS
+LEVEL_SPAWNS = ('sword', 'scroll', 'kobold', 'goblin')
+
+
+class struct_LevelPayload(object):
+    def __init__(self, seed, depth, width, height, tiles, rooms, spawns):
+        self.seed = seed
+        self.depth = depth
+        self.width = width
+        self.height = height
+        # one byte per tile, as in the save file
+        self.tiles = tiles
+        # (x1, y1, x2, y2)
+        self.rooms = rooms
+        # (kind, x, y)
+        self.spawns = spawns
+
+    def make_map(self):
+        grid = struct_TileGrid(self.width, self.height)
+        savefile.unpack_tiles(grid, self.tiles)
+        return grid
+
+
+# runs in the worker processes, so it only takes and returns plain data
+def generate_level(game_seed, depth, width, height, max_rooms, algorithm=None):
+    seed = derive_seed(game_seed, 'mapgen', depth)
+    rng = random.Random(seed)
+    grid, rooms = dungeon.generate(rng.randint, width, height, max_rooms, algorithm)
+
+    # nothing spawns where the player arrives, and the way back up is there
+    start = rooms[0].center()
+    if depth > 1 and not grid.is_stairs(*start):
+        grid.set_stairs(start[0], start[1], kind=STAIRS_UP)
+
+    def occupied(x, y):
+        return (x, y) == start
+
+    cells = grid.sample_free_cells(len(LEVEL_SPAWNS), rng.randint, occupied)
+    spawns = [(kind, x, y) for kind, (x, y) in zip(LEVEL_SPAWNS, cells)]
+
+    tiles = bytes(savefile.pack_tiles(grid, 0, width * height))
+    return struct_LevelPayload(seed, depth, width, height, tiles,
+                               [(room.x1, room.y1, room.x2, room.y2) for room in rooms], spawns)
+
+
+# wrapper for Pool.imap, which passes a single argument
+def _generate_args(args):
+    return generate_level(*args)
+
+
+# Keeps the next few levels generating in the background while the player is busy
+# The pool is only started by prefetch(), so headless runs and tools that never call it
+# make their levels right away in the same process
+class obj_LevelQueue(object):
+    def __init__(self, game_seed, ahead=constants.PREGEN_LEVELS, processes=constants.PREGEN_PROCESSES):
+        self.game_seed = game_seed
+        self.ahead = ahead
+        self.processes = processes
+        self.pool = None
+        # depth -> AsyncResult
+        self.pending = {}
+
+    def _args(self, depth):
+        return (self.game_seed, depth, constants.MAP_WIDTH, constants.MAP_HEIGHT, constants.MAX_ROOMS,
+                constants.MAP_ALGORITHM)
+
+    def prefetch(self, from_depth):
+        if self.ahead <= 0:
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        for depth in range(from_depth, from_depth + self.ahead):
+            if depth not in self.pending:
+                self.pending[depth] = self.pool.apply_async(generate_level, self._args(depth))
+
+    def take(self, depth):
+        result = self.pending.pop(depth, None)
+        if result is not None:
+            # usually done long ago, otherwise we wait for the worker instead of doing it twice
+            payload = result.get()
+        else:
+            payload = generate_level(*self._args(depth))
+
+        # keep the pool busy with what comes after
+        if self.pool is not None:
+            self.prefetch(depth + 1)
+        return payload
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending = {}
+
+
+# many levels at once on all cores, for testing the generator and looking at stats
+def generate_batch(game_seed, count, width, height, max_rooms, processes=None, algorithm=None):
+    pool = multiprocessing.Pool(processes)
+    try:
+        args = [(game_seed, depth, width, height, max_rooms, algorithm) for depth in range(1, count + 1)]
+        for payload in pool.imap(_generate_args, args, chunksize=16):
+            yield payload
+    finally:
+        pool.close()
+        pool.join()
+
+
+def level_stats(payload):
+    size = payload.width * payload.height
+    # bit 0 is "blocked"
+    blocked = sum(1 for tile in bytearray(payload.tiles) if tile & 1)
+    return {
+        'depth': payload.depth,
+        'seed': payload.seed,
+        'rooms': len(payload.rooms),
+        'open': float(size - blocked) / size,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate many levels from a seed and print stats")
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--size', type=int, default=None, help="map width and height")
+    parser.add_argument('--rooms', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=None, help="default: all cores")
+    parser.add_argument('--algorithm', choices=sorted(dungeon.GENERATORS), default=None,
+                        help="default: " + constants.MAP_ALGORITHM)
+    args = parser.parse_args()
+
+    width = args.size or constants.MAP_WIDTH
+    height = args.size or constants.MAP_HEIGHT
+    max_rooms = args.rooms or constants.MAX_ROOMS
+
+    start = timeit.default_timer()
+    stats = [level_stats(payload)
+             for payload in generate_batch(args.seed, args.count, width, height, max_rooms, args.processes,
+                                           args.algorithm)]
+    elapsed = timeit.default_timer() - start
+
+    rooms = [stat['rooms'] for stat in stats]
+    open_share = [stat['open'] for stat in stats]
+    print("Generated " + str(len(stats)) + " levels in " + str(round(elapsed, 2)) + "s (" +
+          str(round(len(stats) / elapsed, 1)) + " levels/s)")
+    print("Rooms: min " + str(min(rooms)) + ", max " + str(max(rooms)) + ", mean " +
+          str(round(float(sum(rooms)) / len(rooms), 2)))
+    print("Open tiles: min " + str(round(min(open_share), 3)) + ", max " + str(round(max(open_share), 3)) +
+          ", mean " + str(round(sum(open_share) / len(open_share), 3)))
@@ -0,0 +1,188 @@
+# coding: utf8
+# The levels the player has been to but isn't on
+# Only the current level is live (a struct_TileGrid and entity objects). When the player leaves a level,
+# it's packed (tiles, rooms and entity records, as in the save file) and compressed into a small blob.
+# The last few blobs stay in memory; older ones are appended to a file, and only read back
+# (and only turned back into a map and entities) when the player returns to that level
+# The save file doesn't repeat any of it, it only keeps the index of the file (see savefile LVST),
+# so a save writes the blobs still in memory to the file too, once each, and they stay in memory
+import os
+import struct
+import zlib
+from collections import OrderedDict
+
+import constants
+import savefile
+from savefile import struct_Cursor
+from tilegrid import struct_TileGrid
+
+_MAP_HEADER = struct.Struct("<ii")
+_RECT = struct.Struct("<iiii")
+_U32 = struct.Struct("<I")
+
+
+def pack_level(grid, rooms, entities):
+    parts = [_MAP_HEADER.pack(grid.width, grid.height), bytes(savefile.pack_tiles(grid, 0, grid.width * grid.height)),
+             _U32.pack(len(rooms))]
+    parts.extend(_RECT.pack(room.x1, room.y1, room.x2, room.y2) for room in rooms)
+    parts.append(_U32.pack(len(entities)))
+    for ent in entities:
+        packed = savefile.pack_entity(ent)
+        parts.append(_U32.pack(len(packed)))
+        parts.append(packed)
+    return zlib.compress(b"".join(parts))
+
+
+# what pack_level packed, back as a map, rooms and entities
+# registry is the same as for the save file (main.save_registry)
+def unpack_level(blob, registry):
+    cursor = struct_Cursor(zlib.decompress(blob))
+    width, height = cursor.unpack(_MAP_HEADER)
+    grid = struct_TileGrid(width, height)
+    savefile.unpack_tiles(grid, cursor.read(width * height))
+
+    count, = cursor.unpack(_U32)
+    rooms = []
+    for i in range(count):
+        x1, y1, x2, y2 = cursor.unpack(_RECT)
+        rooms.append(registry['Rect'](x1, y1, x2 - x1, y2 - y1))
+
+    count, = cursor.unpack(_U32)
+    entities = []
+    for i in range(count):
+        length, = cursor.unpack(_U32)
+        entities.append(savefile.unpack_entity(struct_Cursor(cursor.read(length)), registry))
+    return grid, rooms, entities
+
+
+class obj_LevelStore(object):
+    # index comes from a save: depth -> (offset, length) of the levels already in the file
+    # without one, this is a new game and the file starts over the first time anything is written to it
+    def __init__(self, path=constants.LEVEL_STORE_FILE, cache_size=constants.LEVEL_CACHE_SIZE, index=None):
+        self.path = path
+        self.cache_size = cache_size
+        # depth -> compressed level, least recently left first
+        self.cache = OrderedDict()
+        # depth -> (offset, length) in the file, a level in the cache can be in here as well once it's been saved
+        self.index = dict(index) if index is not None else {}
+        self.new_file = index is None
+        self.file = None
+        # bytes in the file that belong to levels that were taken back out
+        self.dead = 0
+        # the file the save on disk points at, compacting never writes over it
+        self.saved_path = path if index is not None else None
+        # the file compact() moved away from, removed once a save points at the new one
+        self.stale_path = None
+
+    def __contains__(self, depth):
+        return depth in self.cache or depth in self.index
+
+    def __len__(self):
+        return len(set(self.cache) | set(self.index))
+
+    def _open(self):
+        if self.file is None:
+            if self.new_file or not os.path.exists(self.path):
+                self.file = open(self.path, 'w+b')
+                self.index = {}
+            else:
+                self.file = open(self.path, 'r+b')
+            self.new_file = False
+        return self.file
+
+    def _spill(self, depth, blob):
+        level_file = self._open()
+        level_file.seek(0, os.SEEK_END)
+        self.index[depth] = (level_file.tell(), len(blob))
+        level_file.write(blob)
+
+    def _read(self, offset, length):
+        level_file = self._open()
+        level_file.seek(offset)
+        return level_file.read(length)
+
+    # the player left this level
+    def put(self, depth, grid, rooms, entities):
+        self._forget(depth)
+        self.cache[depth] = pack_level(grid, rooms, entities)
+        while len(self.cache) > self.cache_size:
+            old_depth, blob = self.cache.popitem(last=False)
+            if old_depth not in self.index:
+                self._spill(old_depth, blob)
+
+    # the player is back: (grid, rooms, entities), or None if they've never been here
+    # the level leaves the store, it's put back when the player leaves it again
+    def take(self, depth, registry):
+        blob = self.cache.pop(depth, None)
+        where = self.index.pop(depth, None)
+        if where is not None:
+            if blob is None:
+                blob = self._read(*where)
+            self.dead += where[1]
+        if blob is None:
+            return None
+        return unpack_level(blob, registry)
+
+    def _forget(self, depth):
+        self.cache.pop(depth, None)
+        where = self.index.pop(depth, None)
+        if where is not None:
+            self.dead += where[1]
+
+    # Everything to the file (for the save), returns the index of the file
+    # The levels in memory are written if they aren't in the file yet, and stay in memory
+    # The file only ever grows between saves, so an older save's index stays valid until the next one;
+    # here the levels that were taken back out are dropped by writing the others to a new file:
+    # always when compact is True, and otherwise (e.g. an autosave) once they take up more than the live ones
+    # The save has to record self.path, and call saved() once it's on disk
+    def flush(self, compact=True):
+        for depth, blob in self.cache.items():
+            if depth not in self.index:
+                self._spill(depth, blob)
+        live = sum(length for offset, length in self.index.values())
+        if self.dead and (compact or self.dead > live) and self.spare_path() != self.saved_path:
+            self.compact()
+        if self.file is not None:
+            # the save is about to point at these bytes, they have to be on disk before it is
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return dict(self.index)
+
+    # the store switches between two files, e.g. levels.dat and levels.dat.1
+    def spare_path(self):
+        if self.path.endswith(".1"):
+            return self.path[:-2]
+        return self.path + ".1"
+
+    # The levels still in the store go to the spare file, which becomes the store's file
+    # The old one is left alone: the save on disk may still point at it (see saved())
+    def compact(self):
+        records = [(depth, self._read(offset, length)) for depth, (offset, length) in sorted(self.index.items())]
+        self.close()
+        new_path = self.spare_path()
+        index = {}
+        with open(new_path, 'wb') as new_file:
+            for depth, blob in records:
+                index[depth] = (new_file.tell(), len(blob))
+                new_file.write(blob)
+            new_file.flush()
+            os.fsync(new_file.fileno())
+        if self.stale_path is None:
+            self.stale_path = self.path
+        self.path = new_path
+        self.new_file = False
+        self.index = index
+        self.dead = 0
+
+    # a save that points at path is on disk now, so the file compact() left behind can go
+    def saved(self, path):
+        self.saved_path = path
+        if self.stale_path is not None and self.stale_path != path:
+            if os.path.exists(self.stale_path):
+                os.remove(self.stale_path)
+            self.stale_path = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,114 +1,255 @@
 # coding: utf8
 
-from bearlibterminal import terminal as blt
-import libtcodpy as libtcod
+try:
+    from bearlibterminal import terminal as blt
+except ImportError:
+    # no window, e.g. for headless runs
+    import null_terminal as blt
 import math
 
 #save/load
-import jsonpickle
-import json
 import os
 
 import constants
 import renderer
-
-# Needed for map
-class struct_Tile(object):
-    def __init__(self, block_path):
-        self.block_path = block_path
-        self.explored = False
-        self.stairs = False
+import projection
+import gameloop
+import savefile
+import autosave
+from messages import obj_MessageLog
+from tilegrid import STAIRS_DOWN, STAIRS_UP
+from spatial import obj_SpatialIndex
+from fovmap import obj_FovMap
+from visibility import obj_Visibility
+from pathfinding import obj_Pathfinder
+from turns import obj_TurnScheduler, action_delay
+import levelgen
+import levelstore
+import dungeon
+from dungeon import Rect
+import rng
+from components import STORE, field, flag
+import gamelog
+from profiler import PROFILER, profiled
+
+# categories of the internal log
+COMBAT_LOG = gamelog.get_logger('combat')
+MAPGEN_LOG = gamelog.get_logger('mapgen')
+AI_LOG = gamelog.get_logger('ai')
+
+# the incremental renderer, set up in game_initialize
+MAP_RENDERER = None
+# frame/turn timing of the running game, set up in game_main_loop
+FRAME_CLOCK = None
+# the random number streams of the current game, set up by obj_Game
+RNG = None
+# the map cell under the mouse, None when the mouse isn't over the map
+MOUSE_CELL = None
+# the autosave journal and the background saves, set up in game_initialize (None: nothing is journaled)
+JOURNAL = None
+AUTOSAVE = None
 
 # Storing our stuff in one place
 # Most importantly this stores the entities on map and the messages to be displayed
 class obj_Game(object):
-    def __init__(self):
-        self.current_map, self.current_rooms = map_create()
+    def __init__(self, current_map=None, current_rooms=None, fov_map=None, seed=None, depth=1):
+        # everything random in the game comes from this seed, see rng
+        if seed is None:
+            seed = rng.new_game_seed()
+        self.seed = seed
+        self.depth = depth
+        global RNG
+        RNG = self.rng = rng.obj_RandomStreams(seed)
+        # the next levels, made in the background once prefetch() was called
+        self.levels = levelgen.obj_LevelQueue(seed)
+        # the levels we've been to, other than this one
+        self.level_store = levelstore.obj_LevelStore()
+
+        # make a new map unless we already have one (e.g. from a save)
+        if current_map is None:
+            current_map, current_rooms = map_create(self.rng.derive('mapgen', depth).randint)
+        self.current_map, self.current_rooms = current_map, current_rooms
+        # knows which entities stand on which cell
+        self.entity_index = obj_SpatialIndex()
         self.current_entities = []
-        self.message_history = []
+        self.message_history = obj_MessageLog()
+        # the autosave journal segment that goes on from the save this came from, see load_game
+        self.journal_seq = None
 
         global FOV_MAP
-        FOV_MAP = map_make_fov(self.current_map)
-
+        if fov_map is None:
+            fov_map = map_make_fov(self.current_map)
+        FOV_MAP = fov_map
+        # line of sight for the monsters, cached per origin (see visibility.py)
+        self.visibility = obj_Visibility(self.current_map)
+        # shared paths, e.g. towards the player (only monsters within CHASE_DISTANCE use them)
+        self.pathfinder = obj_Pathfinder(self.current_map, constants.CHASE_DISTANCE)
+
+    # replacing the whole list (e.g. on a new level) rebuilds the index
+    @property
+    def current_entities(self):
+        return self._current_entities
+
+    @current_entities.setter
+    def current_entities(self, entities):
+        self._current_entities = entities
+        self.entity_index.rebuild(entities)
+        # who gets to act after the player, only holds the monsters
+        self.scheduler = obj_TurnScheduler(self.entity_index)
+        for ent in entities:
+            self.scheduler.add(ent)
 
     def add_entity(self, entity):
         if entity is not None:
             self.current_entities.append(entity)
-    
+            self.entity_index.add(entity)
+            self.scheduler.add(entity)
+            if JOURNAL is not None:
+                JOURNAL.added(entity)
+
+    def remove_entity(self, entity):
+        self.current_entities.remove(entity)
+        self.entity_index.remove(entity)
+        self.scheduler.remove(entity)
+        if JOURNAL is not None:
+            JOURNAL.removed(entity)
+
     def game_message(self, msg, msg_color):
-        self.message_history.append((msg, msg_color))
+        self.message_history.add(msg, msg_color)
+        if JOURNAL is not None:
+            JOURNAL.message(msg, msg_color)
 
     def next_level(self):
-        global FOV_CALCULATE
         self.game_message("You descend deeper in the dungeon", "violet")
-
-        # make the map
-        self.current_map, self.current_rooms = map_create()
-        global FOV_MAP
+        self.change_level(self.depth + 1)
+
+    def previous_level(self):
+        self.game_message("You climb back up", "violet")
+        self.change_level(self.depth - 1)
+
+    def change_level(self, depth):
+        global FOV_CALCULATE, FOV_MAP
+        # the journal only needs the depth, replaying it makes the same change
+        if JOURNAL is not None:
+            JOURNAL.level_changing(depth)
+        # the level we're leaving is packed away, everything but the player
+        self.level_store.put(self.depth, self.current_map, self.current_rooms,
+                             [ent for ent in self.current_entities if ent is not PLAYER])
+        going_down = depth > self.depth
+        self.depth = depth
+
+        stored = self.level_store.take(depth, save_registry())
+        if stored is not None:
+            # been here before: everything is as we left it
+            self.current_map, self.current_rooms, entities = stored
+            # and we arrive on the stairs we took to leave it
+            arrival = self.current_map.find_stairs(STAIRS_UP if going_down else STAIRS_DOWN)
+            if arrival is None:
+                arrival = self.current_rooms[0].center()
+        else:
+            # the map was (most likely) made in the background already
+            level = self.levels.take(depth)
+            self.current_map = level.make_map()
+            self.current_rooms = [Rect(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in level.rooms]
+            # whatever lives down here
+            entities = [spawn(kind, x, y) for kind, x, y in level.spawns]
+            # the center of room 0
+            arrival = self.current_rooms[0].center()
+
+        # the old level's helpers stop listening to its map, so they don't hang on in a cycle with it
+        FOV_MAP.detach()
+        self.visibility.detach()
+        self.pathfinder.detach()
         FOV_MAP = map_make_fov(self.current_map)
+        self.visibility = obj_Visibility(self.current_map)
+        self.pathfinder = obj_Pathfinder(self.current_map, constants.CHASE_DISTANCE)
 
         # clear list of current entities
         self.current_entities = []
         # append player
         self.add_entity(PLAYER)
-
-        # move player to center of room 0
-        PLAYER.x, PLAYER.y = self.current_rooms[0].center()
+        PLAYER.x, PLAYER.y = arrival
+        for ent in entities:
+            self.add_entity(ent)
+        if JOURNAL is not None:
+            JOURNAL.level_changed(self.current_entities)
 
         # force recalc the FOV
         FOV_CALCULATE = True
 
-class Rect(object):
-    # a rectangle on the map. used to characterize a room.
-    def __init__(self, x, y, w, h):
-        self.x1 = x
-        self.y1 = y
-        self.x2 = x + w
-        self.y2 = y + h
-
-    def center(self):
-        center_x = (self.x1 + self.x2) / 2
-        center_y = (self.y1 + self.y2) / 2
-        return (center_x, center_y)
-
-    def intersect(self, other):
-        # returns true if this rectangle intersects with another one
-        return (self.x1 <= other.x2 and self.x2 >= other.x1 and
-                self.y1 <= other.y2 and self.y2 >= other.y1)
-
-
 # Entity
+# Entities and components are __slots__ facades over the columns in components.STORE
 class obj_Entity(object):
     ''' Name is the name of the whole class, e.g. "goblin"'''
+    __slots__ = ("row", "spatial_index", "char", "name",
+                 "_creature", "_ai", "_container", "_item", "_equipment", "__weakref__")
+    table = STORE.entities
+    _xs = table.column('x')
+    _ys = table.column('y')
+
     def __init__(self, x, y, char, name, creature=None, ai=None, container=None, item=None, equipment=None):
-        self.x = x
-        self.y = y
+        self.row = self.table.allocate(self)
+        # set by obj_SpatialIndex when the entity is on the map
+        self.spatial_index = None
+        self._xs[self.row] = x
+        self._ys[self.row] = y
         self.char = char
         self.name = name
 
         # both creature and AI are optional
+        self._creature = self._ai = self._container = self._item = self._equipment = None
         self.creature = creature
-
-        if self.creature:
-            creature.owner = self
-
         self.ai = ai
-        if self.ai:
-            ai.owner = self
 
         # container allows the player to pick up items
         self.container = container
-        if self.container:
-            container.owner = self
 
         # these optional components make the entity an pickable and/or wearable item
         self.item = item
-        if self.item:
-            item.owner = self
-
         self.equipment = equipment
-        if self.equipment:
-            equipment.owner = self
+
+    # moving an entity keeps the spatial index up to date
+    @property
+    def x(self):
+        return self._xs[self.row]
+
+    @x.setter
+    def x(self, value):
+        if self.spatial_index is not None:
+            self.spatial_index.move(self, self.x, self.y, value, self.y)
+        self._xs[self.row] = value
+
+    @property
+    def y(self):
+        return self._ys[self.row]
+
+    @y.setter
+    def y(self, value):
+        if self.spatial_index is not None:
+            self.spatial_index.move(self, self.x, self.y, self.x, value)
+        self._ys[self.row] = value
+
+    # components know their owner, and forget it when they're taken off
+    def _set_component(self, name, component):
+        old = getattr(self, name)
+        if old is not None and old is not component:
+            old.owner = None
+            old.table.owners[old.row] = -1
+        if component is not None:
+            component.owner = self
+            component.table.owners[component.row] = self.row
+        setattr(self, name, component)
+
+    creature = property(lambda self: self._creature,
+                        lambda self, component: self._set_component('_creature', component))
+    ai = property(lambda self: self._ai,
+                  lambda self, component: self._set_component('_ai', component))
+    container = property(lambda self: self._container,
+                         lambda self, component: self._set_component('_container', component))
+    item = property(lambda self: self._item,
+                    lambda self, component: self._set_component('_item', component))
+    equipment = property(lambda self: self._equipment,
+                         lambda self, component: self._set_component('_equipment', component))
 
     def display_name(self):
         if self.creature:
@@ -120,18 +261,6 @@ class obj_Entity(object):
             else:
                 return self.name
 
-    def draw(self):
-        is_visible = libtcod.map_is_in_fov(FOV_MAP, self.x, self.y)
-
-        if is_visible:
-            tile_x, tile_y = renderer.draw_iso(self.x, self.y)
-            # draw our entity's ASCII symbol at an offset
-            # blt.put_ext(tile_x, tile_y, 0, blt.state(blt.TK_CELL_HEIGHT), self.char)
-
-            # draw the tile at different offset because size of a tile is much different than the size of an ASCII letter
-            blt.put_ext(tile_x, tile_y, 0, 2, self.char)
-
-
     def distance_to(self, other):
         # return the distance to another object
         dx = other.x - self.x
@@ -141,9 +270,25 @@ class obj_Entity(object):
 # Something that can move and fight
 class com_Creature(object):
     ''' Name_instance is the name of an individual, e.g. "Agrk"'''
+    __slots__ = ("row", "owner", "__weakref__")
+    table = STORE.add_table('creature',
+                            (('max_hp', 'i', 0), ('hp', 'i', 0), ('num_dice', 'i', 0), ('damage_dice', 'i', 0),
+                             ('base_def', 'i', 0), ('speed', 'i', constants.NORMAL_SPEED)),
+                            ('name_instance', 'death_function'))
+    name_instance = field(table, 'name_instance')
+    max_hp = field(table, 'max_hp')
+    hp = field(table, 'hp')
+    num_dice = field(table, 'num_dice')
+    damage_dice = field(table, 'damage_dice')
+    base_def = field(table, 'base_def')
+    death_function = field(table, 'death_function')
+    speed = field(table, 'speed')
+
     def __init__(self, name_instance,
                  num_dice = 1, damage_dice = 6, base_def = 0, hp=10,
-                 death_function=None):
+                 death_function=None, speed=constants.NORMAL_SPEED):
+        self.row = self.table.allocate(self)
+        self.owner = None
         self.name_instance = name_instance
         self.max_hp = hp
         self.hp = hp
@@ -151,20 +296,31 @@ class com_Creature(object):
         self.damage_dice = damage_dice
         self.base_def = base_def
         self.death_function = death_function
+        self.speed = speed
 
+    # own dice, plus whatever is equipped (totals kept up to date by com_Container)
     @property
     def attack_mod(self):
         total_attack = roll(self.num_dice, self.damage_dice)
 
+        container = self.owner.container
+        if container is not None:
+            total_attack += container.attack_bonus
+            for dice, sides in container.damage_dice:
+                total_attack += roll(dice, sides)
+
         return total_attack
 
-    def move(self, dx, dy):
-        if self.owner.y + dy >= len(GAME.current_map) or self.owner.y < 0:
-            print("Tried to move out of map")
-            return
+    @property
+    def defense(self):
+        container = self.owner.container
+        if container is None:
+            return self.base_def
+        return self.base_def + container.defense_bonus
 
-        if self.owner.x + dx >= len(GAME.current_map) or self.owner.x < 0:
-            print("Tried to move out of map")
+    def move(self, dx, dy):
+        if not GAME.current_map.in_bounds(self.owner.x + dx, self.owner.y + dy):
+            AI_LOG.debug("%s tried to move out of map", self.name_instance)
             return
 
         target = None
@@ -172,16 +328,20 @@ class com_Creature(object):
         target = map_check_for_creature(self.owner.x + dx, self.owner.y + dy, self.owner)
 
         if target:
-            damage_dealt = self.attack_mod
+            damage_dealt = max(0, self.attack_mod - target.creature.defense)
             self.attack(target, damage_dealt)
 
-        tile_is_wall = (GAME.current_map[self.owner.x + dx][self.owner.y + dy].block_path == True)
+        tile_is_wall = GAME.current_map.is_blocked(self.owner.x + dx, self.owner.y + dy)
 
         if not tile_is_wall and target is None:
             self.owner.x += dx
             self.owner.y += dy
+            if JOURNAL is not None:
+                JOURNAL.moved(self.owner)
 
     def attack(self, target, damage):
+        # fights are loud
+        GAME.scheduler.noise(self.owner.x, self.owner.y)
 
         GAME.game_message(self.name_instance + " attacks " + target.creature.name_instance + " for " +
                      str(damage) +
@@ -190,6 +350,8 @@ class com_Creature(object):
 
     def take_damage(self, damage):
         self.hp -= damage
+        if JOURNAL is not None:
+            JOURNAL.hp_changed(self.owner)
         GAME.game_message(self.name_instance + "'s hp is " + str(self.hp) + "/" + str(self.max_hp), "white")
 
         if self.hp <= 0:
@@ -198,20 +360,74 @@ class com_Creature(object):
 
 # Inventory and items
 class com_Container(object):
+    __slots__ = ("row", "owner", "__weakref__")
+    table = STORE.add_table('container', (('attack_bonus', 'i', 0), ('defense_bonus', 'i', 0)),
+                            ('inventory', 'slots', 'damage_dice'))
+    inventory = field(table, 'inventory')
+    # slot -> the com_Equipment in it
+    slots = field(table, 'slots')
+    # totals of everything equipped, only recomputed on equip/unequip so combat doesn't look at the inventory
+    attack_bonus = field(table, 'attack_bonus')
+    defense_bonus = field(table, 'defense_bonus')
+    # (dice, sides) pairs, one per kind of die
+    damage_dice = field(table, 'damage_dice')
+
     def __init__(self, inventory = None):
+        self.row = self.table.allocate(self)
+        self.owner = None
         if inventory is None:
             inventory = []
         self.inventory = inventory
+        # e.g. from a save, where the equipment remembers it was equipped
+        self.slots = {}
+        for obj in inventory:
+            if obj.equipment and obj.equipment.equipped:
+                self.slots[obj.equipment.slot] = obj.equipment
+        self.update_totals()
 
     @property
     def equipped_items(self):
-        list_equipped = [obj for obj in self.inventory
-                         if obj.equipment and obj.equipment.equipped]
-
-        return list_equipped
+        return [equipment.owner for equipment in self.slots.values()]
+
+    def in_slot(self, slot):
+        return self.slots.get(slot)
+
+    def equip(self, equipment):
+        self.slots[equipment.slot] = equipment
+        self.update_totals()
+        if JOURNAL is not None:
+            JOURNAL.equipped(self.owner, equipment.owner, True)
+
+    def unequip(self, equipment):
+        if self.slots.get(equipment.slot) is equipment:
+            del self.slots[equipment.slot]
+            self.update_totals()
+            if JOURNAL is not None:
+                JOURNAL.equipped(self.owner, equipment.owner, False)
+
+    def update_totals(self):
+        attack_bonus = defense_bonus = 0
+        dice = {}
+        for equipment in self.slots.values():
+            attack_bonus += equipment.attack_bonus
+            defense_bonus += equipment.defense_bonus
+            if equipment.num_dice > 0:
+                dice[equipment.damage_dice] = dice.get(equipment.damage_dice, 0) + equipment.num_dice
+        self.attack_bonus = attack_bonus
+        self.defense_bonus = defense_bonus
+        self.damage_dice = tuple((count, sides) for sides, count in sorted(dice.items()))
 
 class com_Item(object):
+    __slots__ = ("row", "owner", "__weakref__")
+    table = STORE.add_table('item', (('weight', 'd', 0.0),), ('use_function', 'current_container'))
+    weight = field(table, 'weight')
+    use_function = field(table, 'use_function')
+    # the container it's in, once it was picked up
+    current_container = field(table, 'current_container')
+
     def __init__(self, weight=0.0, use_function=None):
+        self.row = self.table.allocate(self)
+        self.owner = None
         self.weight = weight
         self.use_function = use_function
 
@@ -220,14 +436,23 @@ class com_Item(object):
             GAME.game_message("Picking up", "white")
             actor.container.inventory.append(self.owner)
             self.current_container = actor.container
-            GAME.current_entities.remove(self.owner)
+            if JOURNAL is not None:
+                JOURNAL.inventory_added(actor, self.owner)
+            GAME.remove_entity(self.owner)
 
     def drop(self, new_x, new_y):
         GAME.game_message("Item dropped", "white")
+        # take it off first
+        equipment = self.owner.equipment
+        if equipment is not None and equipment.equipped:
+            equipment.equipped = False
+            self.current_container.unequip(equipment)
         self.current_container.inventory.remove(self.owner)
-        GAME.current_entities.append(self.owner)
+        if JOURNAL is not None:
+            JOURNAL.inventory_removed(self.current_container.owner, self.owner)
         self.owner.x = new_x
         self.owner.y = new_y
+        GAME.add_entity(self.owner)
 
     def use(self, actor):
         # equip it if it's a piece of equipment
@@ -239,10 +464,26 @@ class com_Item(object):
             # destroy after use, unless it was cancelled for some reason
             if self.use_function() != 'cancelled':
                 self.current_container.inventory.remove(self.owner)
+                if JOURNAL is not None:
+                    JOURNAL.inventory_removed(self.current_container.owner, self.owner)
 
 
 class com_Equipment(object):
+    __slots__ = ("row", "owner", "__weakref__")
+    table = STORE.add_table('equipment',
+                            (('equipped', 'b', 0), ('num_dice', 'i', 0), ('damage_dice', 'i', 0),
+                             ('attack_bonus', 'i', 0), ('defense_bonus', 'i', 0)),
+                            ('slot',))
+    slot = field(table, 'slot')
+    equipped = flag(table, 'equipped')
+    num_dice = field(table, 'num_dice')
+    damage_dice = field(table, 'damage_dice')
+    attack_bonus = field(table, 'attack_bonus')
+    defense_bonus = field(table, 'defense_bonus')
+
     def __init__(self, slot, num_dice = 1, damage_dice = 4, attack_bonus = 0, defense_bonus = 0):
+        self.row = self.table.allocate(self)
+        self.owner = None
         self.slot = slot
         self.equipped = False
         self.num_dice = num_dice
@@ -263,27 +504,49 @@ class com_Equipment(object):
             old_equipment.unequip(actor)
 
         self.equipped = True
+        actor.container.equip(self)
         GAME.game_message("Item equipped", "white")
 
     def unequip(self, actor):
         self.equipped = False
+        actor.container.unequip(self)
         GAME.game_message("Took off item", "white")
 
 
 
 class AI_test(object):
+    __slots__ = ("row", "owner", "__weakref__")
+    table = STORE.add_table('ai', (('chasing', 'b', 0),))
+    chasing = flag(table, 'chasing')
+
+    def __init__(self):
+        self.row = self.table.allocate(self)
+        self.owner = None
+        self.chasing = False
+
     def take_turn(self):
-        self.owner.creature.move(libtcod.random_get_int(0,-1,1), libtcod.random_get_int(0,-1, 1))
+        monster = self.owner
+        # once we've seen the player, go after them until they get away (see forget_far_chases)
+        if GAME.visibility.can_see(monster.x, monster.y, PLAYER.x, PLAYER.y):
+            self.chasing = True
+
+        step = None
+        if self.chasing:
+            # all chasing monsters share one map of the way to the player
+            step = GAME.pathfinder.step_towards('player', [(PLAYER.x, PLAYER.y)], monster.x, monster.y)
+
+        if step is not None:
+            monster.creature.move(*step)
+        else:
+            monster.creature.move(RNG.randint('ai', -1, 1), RNG.randint('ai', -1, 1))
 
 
 
 def roll(dice, sides):
-    result = 0
-    for i in range(0, dice, 1):
-        roll = libtcod.random_get_int(0, 1, sides)
-        result += roll
+    # all the dice at once
+    result = RNG.roll('combat', dice, sides)
 
-    print 'Rolling ' + str(dice) + "d" + str(sides) + " result: " + str(result)
+    COMBAT_LOG.debug("Rolling %dd%d result: %d", dice, sides, result)
     return result
 
 def death_monster(monster):
@@ -292,29 +555,22 @@ def death_monster(monster):
     monster.creature = None
     monster.ai = None
     # remove from map
-    GAME.current_entities.remove(monster)
+    GAME.remove_entity(monster)
 
 # returns the equipment in a slot, or None if it's empty
 def get_equipped_in_slot(actor, slot):
-    for obj in actor.container.inventory:
-        if obj.equipment and obj.equipment.slot == slot and obj.equipment.equipped:
-            return obj.equipment
-    return None
+    return actor.container.in_slot(slot)
 
 # spells
 def closest_monster(max_range):
-    # find closest enemy, up to a maximum range, and in the player's FOV
-    closest_enemy = None
-    closest_dist = max_range + 1  # start with (slightly more than) maximum range
+    # find closest enemy, up to a maximum range, and in the player's FOV (what's drawn is what can be hit)
+    def is_target(ent):
+        return ent.creature and ent is not PLAYER and FOV_MAP.is_in_fov(ent.x, ent.y)
 
-    for object in GAME.current_entities:
-        if object.creature and not object == PLAYER and libtcod.map_is_in_fov(FOV_MAP, object.x, object.y):
-            # calculate distance between this object and the player
-            dist = PLAYER.distance_to(object)
-            if dist < closest_dist:  # it's closer, so remember it
-                closest_enemy = object
-                closest_dist = dist
-    return closest_enemy
+    found = GAME.entity_index.nearest(PLAYER.x, PLAYER.y, 1, max_range, is_target)
+    if found:
+        return found[0][1]
+    return None
 
 
 def cast_lightning():
@@ -329,199 +585,143 @@ def cast_lightning():
             + str(constants.LIGHTNING_DAMAGE) + ' damage.', "light blue")
     monster.creature.take_damage(constants.LIGHTNING_DAMAGE)
 
-# dungeon generation functions
-def create_room(room, new_map):
-    # go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            new_map[x][y].block_path = False
-
-
-def create_h_tunnel(x1, x2, y, new_map):
-    # horizontal tunnel. min() and max() are used in case x1>x2
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        new_map[x][y].block_path = False
-
-
-def create_v_tunnel(y1, y2, x, new_map):
-    # vertical tunnel
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        new_map[x][y].block_path = False
+# randint(low, high) lets levels be made from a seed, e.g. random.Random(seed).randint
+# algorithm is one of dungeon.GENERATORS, constants.MAP_ALGORITHM by default
+def map_create(randint=None, width=None, height=None, max_rooms=None, algorithm=None):
+    if randint is None:
+        randint = random_int
+    if width is None:
+        width = constants.MAP_WIDTH
+    if height is None:
+        height = constants.MAP_HEIGHT
+    if max_rooms is None:
+        max_rooms = constants.MAX_ROOMS
 
+    return dungeon.generate(randint, width, height, max_rooms, algorithm)
 
-def map_create():
-    new_map = [[struct_Tile(True) for y in range(0, constants.MAP_HEIGHT)] for x in range(0, constants.MAP_WIDTH)]
 
-    rooms = []
-    num_rooms = 0
+# Monsters that got more than CHASE_DISTANCE away from the player give up the chase
+# One pass over the columns for every chasing AI, before any of them acts
+def forget_far_chases():
+    chasing = AI_test.table.column('chasing')
+    xs, ys = STORE.entities.column('x'), STORE.entities.column('y')
+    px, py = PLAYER.x, PLAYER.y
+    limit = constants.CHASE_DISTANCE * constants.CHASE_DISTANCE
+    for entity_row, row in STORE.with_component('ai', where='chasing'):
+        if (xs[entity_row] - px) ** 2 + (ys[entity_row] - py) ** 2 > limit:
+            chasing[row] = 0
 
-    for r in range(constants.MAX_ROOMS):
-        # random width and height
-        w = libtcod.random_get_int(0, constants.ROOM_MIN_SIZE, constants.ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, constants.ROOM_MIN_SIZE, constants.ROOM_MAX_SIZE)
-        # random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, constants.MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, constants.MAP_HEIGHT - h - 1)
-
-        # "Rect" class makes rectangles easier to work with
-        new_room = Rect(x, y, w, h)
-
-        # run through the other rooms and see if they intersect with this one
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-
-        if not failed:
-            # this means there are no intersections, so this room is valid
-
-            # "paint" it to the map's tiles
-            create_room(new_room, new_map)
-
-            # center coordinates of new room, will be useful later
-            (new_x, new_y) = new_room.center()
-
-            if num_rooms == 0:
-                # this is the first room, where the player starts at
-                player_x = new_x
-                player_y = new_y
-            else:
-                # all rooms after the first:
-                # connect it to the previous room with a tunnel
-
-                # center coordinates of previous room
-                (prev_x, prev_y) = rooms[num_rooms - 1].center()
-
-                # draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
-                    # first move horizontally, then vertically
-                    create_h_tunnel(prev_x, new_x, prev_y, new_map)
-                    create_v_tunnel(prev_y, new_y, new_x, new_map)
-                else:
-                    # first move vertically, then horizontally
-                    create_v_tunnel(prev_y, new_y, prev_x, new_map)
-                    create_h_tunnel(prev_x, new_x, new_y, new_map)
-
-            # finally, append the new room to the list
-            rooms.append(new_room)
-            num_rooms += 1
-
-
-    # stairs in final room
-    stairs_x, stairs_y = rooms[len(rooms)-1].center()
-    new_map[stairs_x][stairs_y].stairs = True
-
-    # some walls just to test
-    #new_map[10][10].block_path = True
-    #new_map[12][12].block_path = True
-
-    # walls around the map
-    # for x in range(constants.MAP_WIDTH):
-    #     new_map[x][0].block_path = True
-    #     new_map[x][constants.MAP_WIDTH-1].block_path = True
-    #
-    # for y in range(constants.MAP_HEIGHT):
-    #     new_map[0][y].block_path = True
-    #     new_map[constants.MAP_HEIGHT-1][y].block_path = True
-
-    #map_make_fov(new_map)
-
-    return new_map, rooms
 
 
+# the FOV map follows changes to the map by itself, so this is only needed for a new map
 def map_make_fov(incoming_map):
-    #global FOV_MAP
-
-    #FOV_MAP = libtcod.map_new(constants.MAP_WIDTH, constants.MAP_HEIGHT)
-    fov_map = libtcod.map_new(constants.MAP_WIDTH, constants.MAP_HEIGHT)
-
-    for y in range(constants.MAP_HEIGHT):
-        for x in range(constants.MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x,y,
-                                       not incoming_map[x][y].block_path, not incoming_map[x][y].block_path)
-    return fov_map
+    return obj_FovMap(incoming_map)
 
+@profiled('fov')
 def map_calculate_fov():
     global FOV_CALCULATE
 
     if FOV_CALCULATE:
         FOV_CALCULATE = False
-        libtcod.map_compute_fov(FOV_MAP, PLAYER.x, PLAYER.y, constants.LIGHT_RADIUS, constants.FOV_LIGHT_WALLS,
-                                constants.FOV_ALGO)
+        FOV_MAP.compute(PLAYER.x, PLAYER.y, constants.LIGHT_RADIUS, constants.FOV_LIGHT_WALLS,
+                        constants.FOV_ALGO)
+        visible = GAME.visibility.fov_cells(FOV_MAP, PLAYER.x, PLAYER.y, constants.LIGHT_RADIUS)
+        # the renderer marks them explored when it draws them, the journal wants them now
+        if JOURNAL is not None:
+            JOURNAL.explored(GAME.current_map, visible)
+        if MAP_RENDERER is not None:
+            MAP_RENDERER.fov_changed(GAME.current_map, visible)
 
 def map_check_for_creature(x, y, exclude_entity=None):
-
-    target = None
-
     # find entity that isn't excluded
     if exclude_entity:
-        for ent in GAME.current_entities:
-            if (ent is not exclude_entity
-                and ent.x == x
-                and ent.y == y
-                and ent.creature):
-                target = ent
-
-            if target:
-                return target
+        for ent in GAME.entity_index.at(x, y):
+            if ent is not exclude_entity and ent.creature:
+                return ent
 
     # find any entity if no exclusions
     else:
-        for ent in GAME.current_entities:
-            if (ent.x == x
-                and ent.y == y):
-                target = ent
+        for ent in GAME.entity_index.at(x, y):
+            return ent
 
 def map_check_for_item(x, y):
-    target = None
+    for ent in GAME.entity_index.at(x, y):
+        if ent.item:
+            return ent
+
 
-    for ent in GAME.current_entities:
-        if (ent.x == x
-            and ent.y == y
-            and ent.item):
-            target = ent
 
-        if target:
-            return target
 
 
+# returns True if anything was drawn
+@profiled('draw')
+def draw_game():
+    camera = MAP_RENDERER.camera
+    camera.follow(PLAYER.x, PLAYER.y)
 
+    look = look_at(MOUSE_CELL)
 
+    if constants.INCREMENTAL_RENDER:
+        MAP_RENDERER.set_look(look)
+        return MAP_RENDERER.draw(GAME.current_map, GAME.entity_index, GAME.message_history, PROFILER)
+
+    blt.clear()
 
-def draw_game():
     # draw map
-    renderer.draw_map(GAME.current_map, FOV_MAP)
+    renderer.draw_map(GAME.current_map, FOV_MAP, camera=camera)
 
     # because the map might have been drawn in another color
     blt.color("white")
-    # draw our entities
-    for ent in GAME.current_entities:
-        ent.draw()
+    # draw our entities, the ones in FOV projected all in one go
+    # (positions straight from the columns, see components.py)
+    entities = GAME.current_entities
+    xs, ys = STORE.positions(entities)
+    shown = [i for i in range(len(entities)) if FOV_MAP.is_in_fov(xs[i], ys[i])]
+    screen_x, screen_y = projection.project_many([xs[i] for i in shown], [ys[i] for i in shown],
+                                                 camera.offset_x, camera.offset_y)
+    for j, i in enumerate(shown):
+        # don't bother with what's off screen
+        if 0 <= screen_x[j] < camera.width and 0 <= screen_y[j] < camera.height:
+            renderer.draw_entity(screen_x[j], screen_y[j], entities[i].char)
 
     # draw messages
     renderer.draw_messages(GAME.message_history)
+    renderer.draw_look(look)
+
+    if PROFILER.enabled:
+        renderer.draw_profile(PROFILER)
+    return True
 
 # Get free tiles of our map
 def get_free_tiles(inc_map):
-    free_tiles = []
-    for y in range(len(inc_map)):
-        for x in range(len(inc_map[0])):
-            if not inc_map[x][y].block_path:
-                free_tiles.append((x, y))
-    return free_tiles
+    return inc_map.free_cells()
+
+def random_int(low, high, stream='mapgen'):
+    return RNG.randint(stream, low, high)
+
+def loot_int(low, high):
+    return RNG.randint('loot', low, high)
 
 # The traditional way of picking a random spot seems to be iterating over all tiles, if it's blocked, retry
 # ... if reached a certain number of tries, abort...
 # This way, we only need to pick a random index of a list, we don't have to retry at all
-def random_free_tile(inc_map):
-    free_tiles = get_free_tiles(inc_map)
-    index = libtcod.random_get_int(0, 0, len(free_tiles) - 1)
-    # print("Index is " + str(index))
-    x = free_tiles[index][0]
-    y = free_tiles[index][1]
-    print("Coordinates are " + str(x) + " " + str(y))
-    return x, y
+# The map keeps that list up to date, so we don't even have to build it
+# None if there's no free tile left
+def random_free_tile(inc_map, exclude=None):
+    cell = inc_map.random_free_cell(loot_int, exclude)
+    if cell is None:
+        MAPGEN_LOG.warning("No free tile left")
+        return None
+    MAPGEN_LOG.debug("Coordinates are %d %d", *cell)
+    return cell
+
+# count different free tiles without an entity on them, for spawning many things at once
+# fewer than count if the map doesn't have that many
+def random_free_tiles(game, count):
+    def occupied(x, y):
+        return len(game.entity_index.at(x, y)) > 0
+
+    return game.current_map.sample_free_cells(count, random_int, occupied)
 
 # This function makes sure every NPC has the creature and AI components
 # X,Y need to come last because we're using tuple unwrapping
@@ -539,10 +739,7 @@ def eq_wrapper(char, name, item_slot, x,y):
     return item
 
 
-# this assumes a random spawn location
-# we duplicate some code, sorry
-def usable_item_wrapper(char, name, use, game):
-    x, y = random_free_tile(game.current_map)
+def usable_item_wrapper(char, name, use, x,y):
     item_com = com_Item(use_function=use)
     item = obj_Entity(x, y, char, name, item=item_com)
     return item
@@ -554,67 +751,181 @@ def item_wrapper(char, name, x,y):
     return item
 
 # save/load
-def save_game():
-    data = {
-        'serialized_player_index': jsonpickle.encode(GAME.current_entities.index(PLAYER)),
-        'serialized_game': jsonpickle.encode(GAME),
-    }
+# classes and functions that the save file refers to by name
+def save_registry():
+    names = ('obj_Entity', 'com_Creature', 'com_Container', 'com_Item', 'com_Equipment', 'Rect',
+             'AI_test', 'death_monster', 'cast_lightning')
+    return dict((name, globals()[name]) for name in names)
 
-    # write to file
-    with open('savegame.json', 'w') as save_file:
-        json.dump(data, save_file, indent=4)
+# the game as it is now, for savefile.write_image
+def capture_game(compact_levels=True):
+    return savefile.capture_game(GAME, PLAYER, FOV_MAP, GAME.level_store, compact_levels)
 
-def load_game():
-    with open('savegame.json', 'r') as save_file:
-        data = json.load(save_file)
-
-    game = jsonpickle.decode(data['serialized_game'])
-    player_ind = jsonpickle.decode(data['serialized_player_index'])
-
-    player = game.current_entities[player_ind]
+def save_game(path=constants.SAVE_FILE):
+    # write to file
+    image = capture_game()
+    savefile.write_save_file(path, image, constants.SAVE_COMPRESSION)
+    saved_game(image)
+
+# a save is on disk: the level store's old file (if compacting left one) can go
+def saved_game(image):
+    if image.level_store_path is not None:
+        GAME.level_store.saved(image.level_store_path)
+
+def load_game(path=constants.SAVE_FILE):
+    with open(path, 'rb') as save_file:
+        data = savefile.read_game(save_file, save_registry())
+
+    # the FOV map comes back as it was saved, without rebuilding it from the tiles
+    fov_map = None
+    if data.fov_transparent is not None:
+        fov_map = obj_FovMap(data.current_map, data.fov_transparent, data.fov_walkable)
+        if data.fov_origin is not None:
+            fov_map.compute(*data.fov_origin)
+
+    game = obj_Game(data.current_map, data.current_rooms, fov_map, data.game_seed, data.depth)
+    # carry on with the same random numbers
+    game.rng.set_state(data.rng_states)
+    # the other levels stay in their file until we go there
+    if data.level_index is not None:
+        game.level_store = levelstore.obj_LevelStore(data.level_store_path, index=data.level_index)
+    for ent in data.entities:
+        game.add_entity(ent)
+    game.message_history.extend(data.messages)
+
+    player = game.current_entities[data.player_index]
+    game.journal_seq = data.journal_seq
 
     return game, player
 
+# after load_game: whatever the autosave journal has past the save (e.g. the game crashed)
+# returns the last journal segment, for start_autosave
+def recover_game(journal_path=constants.JOURNAL_FILE):
+    if GAME.journal_seq is None:
+        return 0
+    records, last_seq = autosave.read_journal(journal_path, GAME.journal_seq)
+    if records:
+        autosave.replay(records, GAME, save_registry())
+        GAME.game_message("Recovered " + str(len(records)) + " changes since the last save", "yellow")
+    return last_seq
+
+def start_autosave(last_seq=0, path=constants.SAVE_FILE, journal_path=constants.JOURNAL_FILE):
+    global JOURNAL, AUTOSAVE
+    JOURNAL = autosave.obj_Journal(journal_path)
+    # a loaded game keeps its journal until the next save has it all
+    JOURNAL.open(last_seq, append=last_seq > 0)
+    AUTOSAVE = autosave.obj_Autosave(JOURNAL, capture_game, path, saved=saved_game)
+    AUTOSAVE.save(GAME)
+
+def stop_autosave():
+    global JOURNAL, AUTOSAVE
+    # saves for the last time, the journal isn't needed after that
+    AUTOSAVE.close(GAME)
+    JOURNAL = AUTOSAVE = None
+
 
 # Core game stuff
 def game_main_loop():
+    global FRAME_CLOCK
     game_quit = False
+    FRAME_CLOCK = clock = gameloop.obj_FrameClock()
 
     while not game_quit:
 
-        # clear
-        blt.clear()
-
-        # draw game
-        draw_game()
+        # draw game at most at the target frame rate, refresh term only if something was drawn
+        if clock.frame_due():
+            clock.begin_frame()
+            drew = draw_game()
+            if drew:
+                blt.refresh()
+            clock.end_frame(drew)
+            timeout = clock.wait_timeout()
+            # the profiling overlay changes even while the player is idle
+            if PROFILER.enabled:
+                timeout = min(timeout, constants.PROFILE_OVERLAY_INTERVAL)
+        else:
+            timeout = clock.time_to_next_frame()
 
-        # refresh term
-        blt.refresh()
+        # sleep until there is some input instead of spinning
+        if not gameloop.wait_for_input(blt, timeout, clock):
+            continue
 
         # avoid blocking the game with blt.read
         while not game_quit and blt.has_input():
+            clock.begin_tick()
             player_action = game_handle_keys()
 
-            map_calculate_fov()
-
             if player_action == "QUIT":
                 game_quit = True
 
-            # let the AIs take action
-            if player_action != "no-action" and player_action != "mouse_click":
-                for ent in GAME.current_entities:
-                    if ent.ai:
-                        ent.ai.take_turn()
+            game_process_turn(player_action)
+            clock.end_tick()
 
     # save game
-    save_game()
+    if AUTOSAVE is not None:
+        stop_autosave()
+    else:
+        save_game()
+    GAME.message_history.close()
+    GAME.levels.close()
+    GAME.level_store.close()
+    gamelog.shutdown()
 
     # quit the game
     blt.close()
 
 
+# everything that happens after the player acted
+def game_process_turn(player_action):
+    map_calculate_fov()
+
+    # let the AIs take action, as many turns as they get in the time the player's action took
+    if player_action != "no-action" and player_action != "mouse_click":
+        forget_far_chases()
+        GAME.scheduler.advance(action_delay(PLAYER), PLAYER)
+        PROFILER.count('turns')
+        PROFILER.count('monster turns', GAME.scheduler.acted)
+
+    # the turn goes in the journal, and every now and then a save is written in the background
+    if AUTOSAVE is not None:
+        AUTOSAVE.tick(GAME)
+
+
+# the map cell under the mouse pointer, or None
+def mouse_cell():
+    if MAP_RENDERER is None:
+        return None
+    cell = MAP_RENDERER.camera.screen_to_cell(blt.state(blt.TK_MOUSE_X), blt.state(blt.TK_MOUSE_Y))
+    if cell is None or not GAME.current_map.in_bounds(*cell):
+        return None
+    return cell
+
+# what the player knows is at a map cell, None if nothing
+def look_at(cell):
+    if cell is None:
+        return None
+    x, y = cell
+    game_map = GAME.current_map
+    if not game_map.is_explored(x, y) and not FOV_MAP.is_in_fov(x, y):
+        return None
+    # entities are only seen in FOV
+    if FOV_MAP.is_in_fov(x, y):
+        names = [ent.display_name() for ent in GAME.entity_index.at(x, y)]
+        names = [name for name in names if name]
+        if names:
+            return ", ".join(names)
+    if game_map.stairs_at(x, y) == STAIRS_DOWN:
+        return "stairs down"
+    if game_map.stairs_at(x, y) == STAIRS_UP:
+        return "stairs up"
+    if game_map.is_blocked(x, y):
+        return "wall"
+    return "floor"
+
+
+@profiled('input')
 def game_handle_keys():
-    global FOV_CALCULATE
+    global FOV_CALCULATE, MOUSE_CELL
 
     key = blt.read()
 
@@ -641,8 +952,11 @@ def game_handle_keys():
 
     # use the stairs if any
     if key == blt.TK_PERIOD and blt.check(blt.TK_SHIFT):
-        if GAME.current_map[PLAYER.x][PLAYER.y].stairs:
+        if GAME.current_map.stairs_at(PLAYER.x, PLAYER.y) == STAIRS_DOWN:
             GAME.next_level()
+    if key == blt.TK_COMMA and blt.check(blt.TK_SHIFT):
+        if GAME.current_map.stairs_at(PLAYER.x, PLAYER.y) == STAIRS_UP:
+            GAME.previous_level()
 
     # items
     if key == blt.TK_G:
@@ -657,24 +971,60 @@ def game_handle_keys():
 
     if key == blt.TK_I:
         chosen_item = renderer.inventory_menu("Inventory", PLAYER)
+        # the menu was drawn over the map
+        if MAP_RENDERER is not None:
+            MAP_RENDERER.invalidate()
         if chosen_item is not None:
             if chosen_item.item:
                 chosen_item.item.use(PLAYER)
 
-    
+    # profiling
+    if key == blt.TK_F11:
+        if PROFILER.toggle():
+            GAME.game_message("Profiling on", "yellow")
+        else:
+            GAME.game_message("Profiling off", "yellow")
+    if key == blt.TK_F12:
+        GAME.game_message("Profile written to " + PROFILER.dump(), "yellow")
+
+    # mouse: hovering shows what's there, clicking describes it
+    if key == blt.TK_MOUSE_MOVE:
+        MOUSE_CELL = mouse_cell()
+    if key == blt.TK_MOUSE_LEFT:
+        MOUSE_CELL = mouse_cell()
+        look = look_at(MOUSE_CELL)
+        if look is not None:
+            GAME.game_message("You see: " + look, "white")
+        return "mouse_click"
+
     return "no-action"
 
 
 def generate_items_monsters(game):
-    # test item
-    game.add_entity(eq_wrapper(0x2215, "sword", "main_hand", *random_free_tile(game.current_map)))
-    game.add_entity(usable_item_wrapper(0x203D, "scroll", cast_lightning, game))
+    # test items, unless the map is full
+    for kind in ('sword', 'scroll'):
+        pos = random_free_tile(game.current_map)
+        if pos is not None:
+            game.add_entity(spawn(kind, *pos))
 
-    # two test enemies
+    # two test enemies, on two different free tiles
     # * means we're unwrapping the tuple (Python 2.7 only allows it as the last parameter)
     # the game.add_entity function wraps the current_entities.append and checks if we're not trying to add a None
-    game.add_entity(NPC_wrapper(0xE000, "kobold", *random_free_tile(game.current_map)))
-    game.add_entity(NPC_wrapper(0xE001, "goblin", *random_free_tile(game.current_map)))
+    # on a map with fewer free tiles, the ones that don't fit are left out
+    for kind, pos in zip(('kobold', 'goblin'), random_free_tiles(game, 2)):
+        game.add_entity(spawn(kind, *pos))
+
+
+# what levels made by levelgen can ask for
+SPAWNS = {
+    'sword': lambda x, y: eq_wrapper(0x2215, "sword", "main_hand", x, y),
+    'scroll': lambda x, y: usable_item_wrapper(0x203D, "scroll", cast_lightning, x, y),
+    'kobold': lambda x, y: NPC_wrapper(0xE000, "kobold", x, y),
+    'goblin': lambda x, y: NPC_wrapper(0xE001, "goblin", x, y),
+}
+
+def spawn(kind, x, y):
+    return SPAWNS[kind](x, y)
 
 
 def start_new_game():
@@ -691,14 +1041,18 @@ def start_new_game():
     generate_items_monsters(game)
 
     # put player last
-    game.current_entities.append(player)
+    game.add_entity(player)
 
     return game, player, fov
 
 
 
 def game_initialize():
-    global GAME, PLAYER, FOV_CALCULATE
+    global GAME, PLAYER, FOV_CALCULATE, MAP_RENDERER
+
+    # keep the console quiet, write the log in the background
+    if constants.LOG_FILE is not None:
+        gamelog.configure(path=constants.LOG_FILE)
 
     blt.open()
     # default terminal size is 80x25
@@ -711,6 +1065,9 @@ def game_initialize():
     # needed to avoid insta-close
     blt.refresh()
 
+    # mouse moves and clicks for picking (the menus switch to keyboard only and back)
+    blt.set('input: filter = [keyboard, mouse+]')
+
     # tiles
     # we use Unicode code point 3002 instead of a normal dot because the dot will be necessary for message log
     blt.set("0x3002: gfx/floor_sand.png, align=center")
@@ -725,9 +1082,13 @@ def game_initialize():
     blt.set("0xE000: gfx/kobold.png,  align=center")  # ""
     blt.set("0xE001: gfx/goblin.png, align=center")
 
+    MAP_RENDERER = renderer.obj_MapRenderer()
+
     # if we have a savegame, load it
-    if os.path.isfile('savegame.json'):
+    last_seq = 0
+    if os.path.isfile(constants.SAVE_FILE):
         GAME, PLAYER = load_game()
+        last_seq = recover_game()
 
         # fix player ref
         # player is always last in the entities list
@@ -736,11 +1097,8 @@ def game_initialize():
         #player_id = len(GAME.current_entities) - 1
         #GAME.current_entities[player_id] = PLAYER
 
-        # handle FOV
+        # handle FOV (the FOV map itself came with the save)
         FOV_CALCULATE = True
-        # recreate the fov
-        global FOV_MAP
-        FOV_MAP = map_make_fov(GAME.current_map)
 
         # fix issue where the map is black on turn 1
         map_calculate_fov()
@@ -751,6 +1109,15 @@ def game_initialize():
         # fix issue where the map is black on turn 1
         map_calculate_fov()
 
+    # let the renderer know when entities move
+    GAME.entity_index.listener = MAP_RENDERER.entity_cell_changed
+
+    # start making the next levels while we play this one
+    GAME.levels.prefetch(GAME.depth + 1)
+
+    if constants.AUTOSAVE:
+        start_autosave(last_seq)
+
 # Execute
 if __name__ == '__main__':
     game_initialize()
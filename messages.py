@@ -0,0 +1,64 @@
+# coding: utf8
+from collections import deque
+
+import constants
+
+
+class struct_Message(object):
+    __slots__ = ("msg", "color", "_markup")
+
+    def __init__(self, msg, color):
+        self.msg = msg
+        self.color = color
+        self._markup = None
+
+    # the string the renderer prints, built the first time it's needed
+    @property
+    def markup(self):
+        if self._markup is None:
+            self._markup = "[color=" + str(self.color) + "] " + self.msg
+        return self._markup
+
+
+# Message log that only keeps the last `capacity` messages
+# Older messages are dropped, or appended to spill_path if one is given
+class obj_MessageLog(object):
+    def __init__(self, capacity=constants.MESSAGE_LOG_SIZE, spill_path=constants.MESSAGE_SPILL_FILE):
+        self.entries = deque(maxlen=capacity)
+        # how many messages were ever added, so that the renderer can tell when something new arrived
+        self.total = 0
+        self.spill_path = spill_path
+        self.spill_file = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    # iterating gives (msg, color) pairs, like the old list did
+    def __iter__(self):
+        for entry in self.entries:
+            yield entry.msg, entry.color
+
+    def add(self, msg, color):
+        if len(self.entries) == self.entries.maxlen and self.spill_path is not None:
+            self._spill(self.entries[0])
+        self.entries.append(struct_Message(msg, color))
+        self.total += 1
+
+    def extend(self, messages):
+        for msg, color in messages:
+            self.add(msg, color)
+
+    def last(self, count):
+        if count >= len(self.entries):
+            return list(self.entries)
+        return [self.entries[i] for i in range(len(self.entries) - count, len(self.entries))]
+
+    def _spill(self, entry):
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_path, 'a')
+        self.spill_file.write(entry.msg + "\n")
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
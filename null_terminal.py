@@ -0,0 +1,91 @@
+# coding: utf8
+# A stand-in for BearLibTerminal that draws nothing, for headless runs and benchmarks
+# It only covers the parts of the terminal API the game uses
+# Input comes from a queue filled with push_key(), so scripted players go through game_handle_keys() like a real one
+from collections import deque
+
+# key codes only need to be distinct here
+TK_A = 0x04
+TK_D = 0x07
+TK_G = 0x0A
+TK_I = 0x0C
+TK_COMMA = 0x36
+TK_PERIOD = 0x37
+TK_F11 = 0x44
+TK_F12 = 0x45
+TK_RIGHT = 0x4F
+TK_LEFT = 0x50
+TK_DOWN = 0x51
+TK_UP = 0x52
+TK_SHIFT = 0x70
+TK_ESCAPE = 0x29
+TK_CLOSE = 0xE0
+TK_CHAR = 0xC8
+TK_BKCOLOR = 0xC5
+TK_CELL_HEIGHT = 0xC1
+TK_MOUSE_LEFT = 0x80
+TK_MOUSE_MOVE = 0x85
+TK_MOUSE_X = 0x87
+TK_MOUSE_Y = 0x88
+
+_input = deque()
+_state = {}
+
+# how many drawing calls were made, handy for measuring the renderer
+calls = 0
+
+
+def push_key(key, shift=False):
+    _input.append((key, shift, None))
+
+
+# a mouse event with the pointer at screen cell (x, y)
+def push_mouse(key, x, y):
+    _input.append((key, False, (x, y)))
+
+
+def clear_input():
+    _input.clear()
+
+
+def has_input():
+    return len(_input) > 0
+
+
+def read():
+    if not _input:
+        return TK_CLOSE
+    key, shift, mouse = _input.popleft()
+    _state[TK_SHIFT] = 1 if shift else 0
+    if mouse is not None:
+        _state[TK_MOUSE_X], _state[TK_MOUSE_Y] = mouse
+    return key
+
+
+def check(code):
+    return _state.get(code, 0) != 0
+
+
+def state(code):
+    return _state.get(code, 0)
+
+
+def delay(ms):
+    pass
+
+
+def _draw(*args, **kwargs):
+    global calls
+    calls += 1
+
+
+def _noop(*args, **kwargs):
+    return 0
+
+
+put = put_ext = puts = clear = clear_area = color = bkcolor = layer = _draw
+open = close = set = refresh = composition = _noop
+
+
+def color_from_argb(a, r, g, b):
+    return (a << 24) | (r << 16) | (g << 8) | b
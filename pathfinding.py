@@ -0,0 +1,111 @@
+# coding: utf8
+from array import array
+from collections import deque
+
+# the 8 directions a creature can step in
+DIRECTIONS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+# DIRECTIONS index of the opposite direction
+_OPPOSITE = [DIRECTIONS.index((-dx, -dy)) for dx, dy in DIRECTIONS]
+
+NO_STEP = 255
+
+
+# Distance from every cell to the nearest target, plus the step to take from each cell to get closer
+# One sweep over the map serves every creature heading for the same targets, each of them just reads its cell
+class obj_DijkstraMap(object):
+    def __init__(self, grid, max_distance=None):
+        self.grid = grid
+        # cells further away than this are left unreached, None means the whole map
+        self.max_distance = max_distance
+        self.targets = None
+        self.version = None
+        self.distance = None
+        self.step = None
+
+    def build(self, targets):
+        grid = self.grid
+        width, height = grid.width, grid.height
+        block_path = grid.block_path
+        max_distance = self.max_distance
+
+        distance = array('i', [-1]) * (width * height)
+        step = bytearray([NO_STEP]) * (width * height)
+        # neighbour offsets in the column-major layout, for each direction
+        offsets = [dx * height + dy for dx, dy in DIRECTIONS]
+
+        queue = deque()
+        for x, y in targets:
+            if grid.in_bounds(x, y):
+                index = x * height + y
+                distance[index] = 0
+                queue.append(index)
+
+        # breadth-first, every step costs the same
+        while queue:
+            index = queue.popleft()
+            dist = distance[index] + 1
+            if max_distance is not None and dist > max_distance:
+                continue
+            x, y = divmod(index, height)
+            for direction in range(8):
+                dx, dy = DIRECTIONS[direction]
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx < width and 0 <= ny < height):
+                    continue
+                neighbour = index + offsets[direction]
+                if distance[neighbour] < 0 and not block_path[neighbour]:
+                    distance[neighbour] = dist
+                    # from the neighbour, the way back to us is the opposite direction
+                    step[neighbour] = _OPPOSITE[direction]
+                    queue.append(neighbour)
+
+        self.targets = tuple(targets)
+        self.distance = distance
+        self.step = step
+
+    def distance_at(self, x, y):
+        # -1 if the targets can't be reached from here
+        return self.distance[x * self.grid.height + y]
+
+    # (dx, dy) that brings us closer, or None if we're there already or can't get there
+    def next_step(self, x, y):
+        direction = self.step[x * self.grid.height + y]
+        if direction == NO_STEP:
+            return None
+        return DIRECTIONS[direction]
+
+
+# Keeps the Dijkstra maps for the current level, e.g. one towards the player
+# A map is only rebuilt when its targets moved or the level's tiles changed since it was built
+class obj_Pathfinder(object):
+    def __init__(self, grid, max_distance=None):
+        self.grid = grid
+        self.max_distance = max_distance
+        self.maps = {}
+        # bumped whenever a tile changes
+        self.version = 0
+        self.builds = 0
+
+        grid.listeners.append(self.tiles_changed)
+
+    def detach(self):
+        if self.tiles_changed in self.grid.listeners:
+            self.grid.listeners.remove(self.tiles_changed)
+
+    def tiles_changed(self, indices):
+        self.version += 1
+
+    def get_map(self, name, targets):
+        targets = tuple(targets)
+        dijkstra_map = self.maps.get(name)
+        if dijkstra_map is None:
+            dijkstra_map = self.maps[name] = obj_DijkstraMap(self.grid, self.max_distance)
+
+        if dijkstra_map.targets != targets or dijkstra_map.version != self.version:
+            dijkstra_map.build(targets)
+            dijkstra_map.version = self.version
+            self.builds += 1
+        return dijkstra_map
+
+    def step_towards(self, name, targets, x, y):
+        return self.get_map(name, targets).next_step(x, y)
@@ -0,0 +1,137 @@
+# coding: utf8
+# Where does the time go?
+# Timers around the main parts of a frame/turn (input, FOV, AI, drawing) and counters,
+# with percentiles over the last PROFILE_HISTORY samples of each
+# Off by default; when off, a timed function only pays for one extra call and one attribute check
+import functools
+import json
+import math
+import time
+import timeit
+from collections import deque
+
+import constants
+
+_timer = timeit.default_timer
+
+
+class obj_Profiler(object):
+    def __init__(self, history=constants.PROFILE_HISTORY):
+        self.enabled = False
+        self.history = history
+        # name -> the last few durations, in seconds
+        self.samples = {}
+        # name -> [count, total seconds, slowest], for the whole session
+        self.totals = {}
+        self.counters = {}
+        self.started = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if self.enabled and self.started is None:
+            self.started = time.time()
+        return self.enabled
+
+    def reset(self):
+        self.samples = {}
+        self.totals = {}
+        self.counters = {}
+        self.started = time.time() if self.enabled else None
+
+    def add(self, name, elapsed):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.history)
+            self.totals[name] = [0, 0.0, 0.0]
+        samples.append(elapsed)
+        total = self.totals[name]
+        total[0] += 1
+        total[1] += elapsed
+        if elapsed > total[2]:
+            total[2] = elapsed
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # with PROFILER.scope("name"): ...
+    def scope(self, name):
+        return obj_Scope(self, name)
+
+    # p50, p95 and p99 of the recent samples, in seconds
+    def percentiles(self, name, points=(50, 95, 99)):
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        size = len(samples)
+        # nearest rank
+        return [samples[min(size - 1, max(0, int(math.ceil(point / 100.0 * size)) - 1))] for point in points]
+
+    def report(self):
+        rows = []
+        for name in sorted(self.samples):
+            count, total, slowest = self.totals[name]
+            p50, p95, p99 = self.percentiles(name)
+            rows.append({
+                'name': name,
+                'count': count,
+                'total_ms': total * 1000,
+                'mean_ms': total * 1000 / count,
+                'max_ms': slowest * 1000,
+                'p50_ms': p50 * 1000,
+                'p95_ms': p95 * 1000,
+                'p99_ms': p99 * 1000,
+            })
+        return rows
+
+    def dump(self, path=constants.PROFILE_FILE):
+        data = {
+            'started': self.started,
+            'dumped': time.time(),
+            'history': self.history,
+            'timers': self.report(),
+            'counters': self.counters,
+        }
+        with open(path, 'w') as profile_file:
+            json.dump(data, profile_file, indent=2, sort_keys=True)
+        return path
+
+
+class obj_Scope(object):
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.start = _timer()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.profiler.add(self.name, _timer() - self.start)
+            self.start = None
+        return False
+
+
+# the game's profiler, toggled at runtime
+PROFILER = obj_Profiler()
+
+
+# times every call of the decorated function under name
+def profiled(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            start = _timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PROFILER.add(name, _timer() - start)
+        return wrapper
+    return decorate
@@ -0,0 +1,105 @@
+# coding: utf8
+# Isometric projection between map cells and screen cells
+# based on STI library for LOVE2D: 0,0 is at the top of the screen in the middle, and a cell (x, y) is drawn at
+#   ((x - y) * TILE_WIDTH / 2 + offset_x, (x + y) * TILE_HEIGHT / 2 + offset_y)
+# The offsets (the camera) only shift everything, so the rest is worked out once per map size and looked up
+# Going back from the screen is exact too, for the mouse
+from array import array
+from collections import OrderedDict
+
+import constants
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+HALF_WIDTH = constants.TILE_WIDTH // 2
+HALF_HEIGHT = constants.TILE_HEIGHT // 2
+
+
+def project(x, y, offset_x=0, offset_y=0):
+    return (x - y) * HALF_WIDTH + offset_x, (x + y) * HALF_HEIGHT + offset_y
+
+
+# The map cell whose tile covers screen cell (sx, sy)
+# Tiles are centered on the cell they're drawn at (align=center), so every screen cell belongs to the
+# tile whose diamond it is in, i.e. x = (u + v) / 2 and y = (v - u) / 2 rounded to the nearest whole numbers
+# All in integers, so the cell a tile is drawn at always gives back exactly that tile
+# The result can be off the map, the caller checks
+def unproject(sx, sy, offset_x=0, offset_y=0):
+    du = (sx - offset_x) * HALF_HEIGHT
+    dv = (sy - offset_y) * HALF_WIDTH
+    scale = 2 * HALF_WIDTH * HALF_HEIGHT
+    # floor(n / scale + 1/2)
+    x = (2 * (du + dv) + scale) // (2 * scale)
+    y = (2 * (dv - du) + scale) // (2 * scale)
+    return x, y
+
+
+# Screen positions of every cell of a width x height map, without the offsets
+# Indexed like the map arrays (x * height + y)
+class obj_ProjectionTable(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.screen_x = array('i')
+        self.screen_y = array('i')
+        for x in xrange(width):
+            self.screen_x.extend(array('i', [(x - y) * HALF_WIDTH for y in xrange(height)]))
+            self.screen_y.extend(array('i', [(x + y) * HALF_HEIGHT for y in xrange(height)]))
+
+    def project(self, index, offset_x=0, offset_y=0):
+        return self.screen_x[index] + offset_x, self.screen_y[index] + offset_y
+
+    # many cells at once, as two arrays
+    def project_indices(self, indices, offset_x=0, offset_y=0):
+        screen_x = self.screen_x
+        screen_y = self.screen_y
+        return (array('i', [screen_x[index] + offset_x for index in indices]),
+                array('i', [screen_y[index] + offset_y for index in indices]))
+
+
+# tables for the last few map sizes, most recently used last
+_tables = OrderedDict()
+
+
+def get_table(width, height):
+    key = (width, height)
+    table = _tables.pop(key, None)
+    if table is None:
+        table = obj_ProjectionTable(width, height)
+        while len(_tables) >= constants.PROJECTION_CACHE_SIZE:
+            _tables.popitem(last=False)
+    _tables[key] = table
+    return table
+
+
+# project(xs[i], ys[i]) for every i, as two arrays
+# for cells that aren't on one map, e.g. entities
+def project_many(xs, ys, offset_x=0, offset_y=0):
+    return (array('i', [(x - y) * HALF_WIDTH + offset_x for x, y in zip(xs, ys)]),
+            array('i', [(x + y) * HALF_HEIGHT + offset_y for x, y in zip(xs, ys)]))
+
+
+# The (x, y) of every cell of a map_width x map_height map that lands on a width x height screen
+# Going back from the screen rectangle to u = x - y and v = x + y gives exactly those cells,
+# so this costs the same on a map of any size
+def visible_cells(map_width, map_height, offset_x, offset_y, width, height):
+    # the range of u and v that lands on screen (rounded inwards)
+    u_lo = -(offset_x // HALF_WIDTH)
+    u_hi = (width - 1 - offset_x) // HALF_WIDTH
+    v_lo = -(offset_y // HALF_HEIGHT)
+    v_hi = (height - 1 - offset_y) // HALF_HEIGHT
+
+    found = []
+    for v in xrange(max(v_lo, 0), min(v_hi, map_width + map_height - 2) + 1):
+        # x = (u + v) / 2 and y = (v - u) / 2 have to be on the map
+        lo = max(u_lo, -v, v - 2 * (map_height - 1))
+        hi = min(u_hi, v, 2 * (map_width - 1) - v)
+        # and u and v need the same parity for x and y to be whole
+        if (lo + v) % 2:
+            lo += 1
+        for u in xrange(lo, hi + 1, 2):
+            found.append(((u + v) // 2, (v - u) // 2))
+    return found
@@ -1,81 +1,416 @@
 # coding: utf8
-from bearlibterminal import terminal as blt
-import libtcodpy as libtcod
+try:
+    from bearlibterminal import terminal as blt
+except ImportError:
+    # no window, e.g. for headless runs
+    import null_terminal as blt
+import time
 
 import constants
-
+import projection
+from cellbuffer import obj_CellBuffer
+from tilegrid import STAIRS_UP
+
+# Layers used by the incremental renderer, so that each one can be cleared on its own
+MAP_LAYER = 0
+ENTITY_LAYER = 1
+MESSAGE_LAYER = 2
+OVERLAY_LAYER = 3
+
+# timers shown by the profiling overlay, next to the message log
+OVERLAY_TIMERS = ('input', 'fov', 'ai', 'draw')
+OVERLAY_WIDTH = 40
+# what's under the mouse, in the top left corner
+LOOK_WIDTH = 60
+
+# entities are drawn this many pixels off their cell
+ENTITY_OFFSET = (0, 2)
+
+# what a map cell currently shows on screen
+SHOWN_NONE = 0
+SHOWN_EXPLORED = 1
+SHOWN_VISIBLE = 2
 
 # based on STI library for LOVE2D
 # this places 0,0 at the top of the screen in the middle
 # as opposed to other isometric calculations which might place 0,0 in lower left
 def draw_iso(x,y):
     # we're offsetting so that we can see the lower-left corner of the map, otherwise it only shows the right half of it
-    offset_x = constants.MAP_WIDTH * 4
-    # isometric
-    tile_x = (x - y) * constants.TILE_WIDTH / 2 + offset_x
-    tile_y = (x + y) * constants.TILE_HEIGHT / 2
-    return tile_x, tile_y
-
-def draw_map(map_draw, fov_map):
-    for x in range(0, constants.MAP_WIDTH):
-        for y in range(0, constants.MAP_HEIGHT):
-
-            is_visible = libtcod.map_is_in_fov(fov_map, x, y)
-
-            if is_visible:
-                tile_x, tile_y = draw_iso(x, y)
-                blt.color("white")
-                map_draw[x][y].explored = True
-
-                if map_draw[x][y].stairs == True:
-                    # draw stairs
-                    blt.put(tile_x, tile_y, ">")
-                else:
-                    if map_draw[x][y].block_path == True:
-                        # draw wall
-                        blt.put(tile_x, tile_y, "#")
-
-                    else:
-                        # draw floor
-                        blt.put(tile_x, tile_y, 0x3002)
-                        #we draw the dot for reference so that we know what on-screen position the tile_x, tile_y refers to
-                        blt.put(tile_x, tile_y, ".")
-
-            elif map_draw[x][y].explored:
-                tile_x, tile_y = draw_iso(x, y)
+    return projection.project(x, y, *iso_offset())
+
+def iso_offset():
+    return constants.MAP_WIDTH * constants.TILE_WIDTH // 2, 0
+
+# Which part of the map is on screen
+# The projection itself is in projection, the camera is the offset it adds
+class obj_Camera(object):
+    def __init__(self, width=constants.SCREEN_WIDTH, height=constants.SCREEN_HEIGHT - constants.NUM_MESSAGES,
+                 margin=constants.CAMERA_MARGIN):
+        # the part of the screen the map is drawn in (the message log is below it)
+        self.width = width
+        self.height = height
+        # how close (in tiles) the player gets to the edge before the camera moves
+        self.margin = margin
+        # the same as draw_iso until the camera moves
+        self.offset_x, self.offset_y = iso_offset()
+        # bumped whenever the camera moves, so the renderer knows to redraw everything
+        self.version = 0
+
+    def project(self, x, y):
+        return projection.project(x, y, self.offset_x, self.offset_y)
+
+    # the map cell under screen cell (sx, sy), e.g. the mouse
+    # None if it's not in the map part of the screen
+    def screen_to_cell(self, sx, sy):
+        if not (0 <= sx < self.width and 0 <= sy < self.height):
+            return None
+        return projection.unproject(sx, sy, self.offset_x, self.offset_y)
+
+    # keep (x, y) away from the edges, returns True if the camera moved
+    def follow(self, x, y):
+        tile_x, tile_y = self.project(x, y)
+        margin_x = self.margin * constants.TILE_WIDTH
+        margin_y = self.margin * constants.TILE_HEIGHT
+        if margin_x <= tile_x < self.width - margin_x and margin_y <= tile_y < self.height - margin_y:
+            return False
+        # put it in the middle
+        self.offset_x += self.width // 2 - tile_x
+        self.offset_y += self.height // 2 - tile_y
+        self.version += 1
+        return True
+
+    # the (x, y) of every map cell that is drawn on screen
+    def cells(self, map_width, map_height):
+        return projection.visible_cells(map_width, map_height, self.offset_x, self.offset_y,
+                                        self.width, self.height)
+
+
+# the terminal everything is drawn to, e.g. null_terminal for headless runs
+def set_backend(terminal):
+    global blt
+    blt = terminal
+
+# what a tile is drawn with, bottom to top
+FLOOR_GLYPHS = (0x3002, ".")
+WALL_GLYPHS = ("#",)
+STAIRS_GLYPHS = (">",)
+UP_STAIRS_GLYPHS = ("<",)
+
+def tile_glyphs(map_draw, index):
+    stairs = map_draw.stairs[index]
+    if stairs:
+        return UP_STAIRS_GLYPHS if stairs == STAIRS_UP else STAIRS_GLYPHS
+    elif map_draw.block_path[index]:
+        return WALL_GLYPHS
+    # floor, with a dot for reference so that we know what on-screen position the tile_x, tile_y refers to
+    return FLOOR_GLYPHS
+
+def draw_tile(map_draw, index, tile_x, tile_y):
+    for glyph in tile_glyphs(map_draw, index):
+        blt.put(tile_x, tile_y, glyph)
+
+# the same, into a cell buffer
+def buffer_tile(buf, map_draw, index, tile_x, tile_y, color):
+    for glyph in tile_glyphs(map_draw, index):
+        buf.put(MAP_LAYER, tile_x, tile_y, glyph, color)
+
+# with a camera, only the cells on screen are visited
+def draw_map(map_draw, fov_map, camera=None):
+    explored = map_draw.explored
+    height = map_draw.height
+    if camera is None:
+        cells = ((x, y) for x in range(0, map_draw.width) for y in range(0, height))
+        offset_x, offset_y = iso_offset()
+    else:
+        cells = camera.cells(map_draw.width, height)
+        offset_x, offset_y = camera.offset_x, camera.offset_y
+
+    # which cells get drawn...
+    drawn = []
+    colors = []
+    for x, y in cells:
+        index = x * height + y
+
+        is_visible = fov_map.is_in_fov(x, y)
+
+        if is_visible:
+            explored[index] = 1
+            drawn.append(index)
+            colors.append("white")
+
+        elif explored[index]:
+            drawn.append(index)
+            # shade the explored tiles
+            colors.append("gray")
+
+    # ...where all of them go on screen...
+    screen_x, screen_y = projection.get_table(map_draw.width, height).project_indices(drawn, offset_x, offset_y)
+
+    # ...then gather the whole map and draw it a row at a time
+    buf = obj_CellBuffer()
+    for i, index in enumerate(drawn):
+        buffer_tile(buf, map_draw, index, screen_x[i], screen_y[i], colors[i])
+
+    buf.flush(blt)
+
+
+def draw_entity(tile_x, tile_y, char):
+    # draw our entity's ASCII symbol at an offset
+    # blt.put_ext(tile_x, tile_y, 0, blt.state(blt.TK_CELL_HEIGHT), char)
+
+    # draw the tile at different offset because size of a tile is much different than the size of an ASCII letter
+    blt.put_ext(tile_x, tile_y, ENTITY_OFFSET[0], ENTITY_OFFSET[1], char)
+
+
+# Incremental renderer
+# Instead of clearing and redrawing everything every frame, we remember what each cell shows
+# and only redraw cells whose FOV state, explored flag or occupants changed
+# If nothing changed, draw() does nothing at all
+class obj_MapRenderer(object):
+    def __init__(self, camera=None):
+        if camera is None:
+            camera = obj_Camera()
+        self.camera = camera
+        # camera version the screen was drawn for
+        self.camera_version = None
+        self.map_draw = None
+        # screen positions of the map's cells, see projection
+        self.table = None
+        self.shown = bytearray()
+        # cell indices that were in FOV last time it was computed
+        self.visible = set()
+        self.dirty_tiles = set()
+        self.dirty_entities = set()
+        self.message_count = None
+        self.full_redraw = True
+        # what draw() is about to send to the terminal
+        self.buffer = obj_CellBuffer()
+        # when the profiling overlay was last drawn, None if it isn't on screen
+        self.overlay_time = None
+        # what's under the mouse, and what of it is on screen
+        self.look = None
+        self.look_shown = None
+
+    # next draw() starts from a clear screen, e.g. after a menu was shown
+    def invalidate(self):
+        self.full_redraw = True
+
+    def set_map(self, map_draw):
+        self.map_draw = map_draw
+        self.table = projection.get_table(map_draw.width, map_draw.height)
+        self.shown = bytearray(len(map_draw.block_path))
+        self.visible = set()
+        self.dirty_tiles = set()
+        self.dirty_entities = set()
+        self.full_redraw = True
+
+    # new_visible is the set of cell indices in FOV (from obj_Visibility.fov_cells)
+    def fov_changed(self, map_draw, new_visible):
+        if map_draw is not self.map_draw:
+            self.set_map(map_draw)
+
+        # only cells that entered or left the FOV change what they show
+        changed = new_visible ^ self.visible
+        self.dirty_tiles |= changed
+        self.dirty_entities |= changed
+        self.visible = new_visible
+
+    # hooked up to obj_SpatialIndex.listener
+    def entity_cell_changed(self, x, y):
+        if self.map_draw is not None and self.map_draw.in_bounds(x, y):
+            self.dirty_entities.add(x * self.map_draw.height + y)
+
+    # text for the top left corner, None for nothing
+    def set_look(self, text):
+        self.look = text
+
+    # returns True if anything was drawn (so the caller knows whether to refresh)
+    def draw(self, map_draw, entity_index, msg_history, profiler=None):
+        if map_draw is not self.map_draw:
+            self.set_map(map_draw)
+
+        drew = False
+
+        # everything on screen moved
+        if self.camera.version != self.camera_version:
+            self.full_redraw = True
+
+        # after a clear, nothing needs erasing and rows can be printed in one go
+        cleared = self.full_redraw
+        if self.full_redraw:
+            blt.clear()
+            explored = map_draw.explored
+            height = map_draw.height
+            # what's in FOV counts as explored even if it's off screen
+            for index in self.visible:
+                explored[index] = 1
+            self.shown = bytearray(len(explored))
+            on_screen = [x * height + y for x, y in self.camera.cells(map_draw.width, height)]
+            self.dirty_tiles = set(index for index in on_screen if explored[index])
+            self.dirty_entities = self.visible.intersection(on_screen)
+            self.camera_version = self.camera.version
+            self.message_count = None
+            self.overlay_time = None
+            self.look_shown = None
+            self.full_redraw = False
+            drew = True
+
+        if self.dirty_tiles:
+            blt.layer(MAP_LAYER)
+            self.draw_dirty_tiles(cleared)
+            drew = True
+
+        if self.dirty_entities:
+            blt.layer(ENTITY_LAYER)
+            self.draw_dirty_entities(entity_index, cleared)
+            drew = True
+
+        self.buffer.flush(blt, fill_gaps=cleared)
+
+        if msg_history.total != self.message_count:
+            blt.layer(MESSAGE_LAYER)
+            blt.clear_area(0, constants.SCREEN_HEIGHT - constants.NUM_MESSAGES,
+                           constants.SCREEN_WIDTH, constants.NUM_MESSAGES)
+            draw_messages(msg_history)
+            self.message_count = msg_history.total
+            drew = True
+
+        if profiler is not None and self.draw_overlay(profiler):
+            drew = True
+
+        if self.look != self.look_shown:
+            blt.layer(OVERLAY_LAYER)
+            clear_look()
+            draw_look(self.look)
+            self.look_shown = self.look
+            drew = True
+
+        blt.layer(MAP_LAYER)
+        return drew
+
+    # the numbers change all the time, so they're only redrawn every PROFILE_OVERLAY_INTERVAL
+    def draw_overlay(self, profiler):
+        if not profiler.enabled:
+            if self.overlay_time is None:
+                return False
+            blt.layer(OVERLAY_LAYER)
+            clear_profile()
+            self.overlay_time = None
+            return True
+
+        now = time.time()
+        if self.overlay_time is not None and now - self.overlay_time < constants.PROFILE_OVERLAY_INTERVAL:
+            return False
+        blt.layer(OVERLAY_LAYER)
+        clear_profile()
+        draw_profile(profiler)
+        self.overlay_time = now
+        return True
+
+    def draw_dirty_tiles(self, cleared=False):
+        map_draw = self.map_draw
+        buf = self.buffer
+        explored = map_draw.explored
+        shown = self.shown
+        visible = self.visible
+        camera = self.camera
+        screen_x = self.table.screen_x
+        screen_y = self.table.screen_y
+        offset_x = camera.offset_x
+        offset_y = camera.offset_y
+
+        for index in self.dirty_tiles:
+            if index in visible:
+                explored[index] = 1
+                state = SHOWN_VISIBLE
+            elif explored[index]:
+                state = SHOWN_EXPLORED
+            else:
+                state = SHOWN_NONE
+
+            if state == shown[index]:
+                continue
+
+            tile_x = screen_x[index] + offset_x
+            tile_y = screen_y[index] + offset_y
+            if not (0 <= tile_x < camera.width and 0 <= tile_y < camera.height):
+                # off screen, gets drawn when the camera moves there
+                continue
+            if not cleared:
+                blt.clear_area(tile_x, tile_y, 1, 1)
+            if state == SHOWN_VISIBLE:
+                buffer_tile(buf, map_draw, index, tile_x, tile_y, "white")
+            elif state == SHOWN_EXPLORED:
                 # shade the explored tiles
-                blt.color("gray")
-
-                if map_draw[x][y].stairs == True:
-                    # draw stairs
-                    blt.put(tile_x, tile_y, ">")
-                else:
-                    if map_draw[x][y].block_path == True:
-                        # draw wall
-                        blt.put(tile_x, tile_y, "#")
-
-                    else:
-                        # draw floor
-                        blt.put(tile_x, tile_y, 0x3002)
-                        #we draw the dot for reference so that we know what on-screen position the tile_x, tile_y refers to
-                        blt.put(tile_x, tile_y, ".")
+                buffer_tile(buf, map_draw, index, tile_x, tile_y, "gray")
+            shown[index] = state
+
+        self.dirty_tiles = set()
+
+    def draw_dirty_entities(self, entity_index, cleared=False):
+        height = self.map_draw.height
+        camera = self.camera
+        buf = self.buffer
+        screen_x = self.table.screen_x
+        screen_y = self.table.screen_y
+        offset_x = camera.offset_x
+        offset_y = camera.offset_y
+
+        for index in self.dirty_entities:
+            tile_x = screen_x[index] + offset_x
+            tile_y = screen_y[index] + offset_y
+            if not (0 <= tile_x < camera.width and 0 <= tile_y < camera.height):
+                continue
+            if not cleared:
+                blt.clear_area(tile_x, tile_y, 1, 1)
+            # entities are only shown in FOV
+            if index in self.visible:
+                x, y = divmod(index, height)
+                # items first, so that creatures are drawn on top of them
+                for ent in sorted(entity_index.at(x, y), key=lambda ent: ent.creature is not None):
+                    buf.put(ENTITY_LAYER, tile_x, tile_y, ent.char, "white", ENTITY_OFFSET)
+
+        self.dirty_entities = set()
 
 
 def draw_messages(msg_history):
-    if len(msg_history) <= constants.NUM_MESSAGES:
-        to_draw = msg_history
-    else:
-        to_draw = msg_history[-constants.NUM_MESSAGES:]
+    to_draw = msg_history.last(constants.NUM_MESSAGES)
 
     start_y = 45 - (constants.NUM_MESSAGES)
 
     i = 0
-    for message, color in to_draw:
-        string = "[color=" + str(color) + "] " + message
-        blt.puts(2, start_y+i, string)
+    for message in to_draw:
+        blt.puts(2, start_y+i, message.markup)
 
         i += 1
 
+def clear_profile():
+    rows = len(OVERLAY_TIMERS) + 1
+    blt.clear_area(constants.SCREEN_WIDTH - OVERLAY_WIDTH, constants.SCREEN_HEIGHT - rows, OVERLAY_WIDTH, rows)
+
+# p50/p95/p99 of the main timers, in the bottom right corner
+def draw_profile(profiler):
+    x = constants.SCREEN_WIDTH - OVERLAY_WIDTH
+    y = constants.SCREEN_HEIGHT - len(OVERLAY_TIMERS) - 1
+
+    blt.color("white")
+    blt.puts(x, y, "[color=yellow]%-6s %8s %8s %8s ms" % ("", "p50", "p95", "p99"))
+    for i, name in enumerate(OVERLAY_TIMERS):
+        values = profiler.percentiles(name)
+        if values is None:
+            line = "%-6s %8s %8s %8s" % (name, "-", "-", "-")
+        else:
+            line = "%-6s %8.2f %8.2f %8.2f" % tuple([name] + [value * 1000 for value in values])
+        blt.puts(x, y + 1 + i, line)
+
+def clear_look():
+    blt.clear_area(0, 0, LOOK_WIDTH, 1)
+
+def draw_look(text):
+    if text:
+        blt.color("white")
+        blt.puts(0, 0, text[:LOOK_WIDTH])
+
 # GUI
 # based on https://github.com/FirstAidKitten/Roguelike-Sandbox
 def create_window(x, y, w, h, title=None):
@@ -120,6 +455,11 @@ def menu(header, options, width, title=None):
     menu_y = int((50 - menu_h) / 2)
 
     # create a window
+    # the window goes on the map layer, so nothing should be left on the layers above it
+    for layer in (ENTITY_LAYER, MESSAGE_LAYER):
+        blt.layer(layer)
+        blt.clear_area(menu_x - 2, menu_y - 2, width + 4, menu_h + 4)
+    blt.layer(MAP_LAYER)
 
     create_window(menu_x, menu_y, width, menu_h, title)
 
@@ -0,0 +1,77 @@
+# coding: utf8
+# Random numbers for one game
+# Every part of the game draws from its own stream, all of them seeded from the game seed,
+# so e.g. an extra dice roll doesn't change the next level or where the monsters wander
+# Same seed and same player input give the same game, which makes runs reproducible
+import random
+import zlib
+from array import array
+
+import constants
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+STREAMS = ('mapgen', 'combat', 'ai', 'loot')
+
+
+# a seed for e.g. ("mapgen", depth 3) of a game, the same on every platform and in every process
+def derive_seed(game_seed, name, *keys):
+    value = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+    for key in keys:
+        value = (value * 1000003 + key) & 0xffffffffffff
+    return (game_seed * 2654435761 + value) & 0x7fffffffffff
+
+
+def new_game_seed():
+    if constants.GAME_SEED is not None:
+        return constants.GAME_SEED
+    return random.randrange(0x7fffffff)
+
+
+class obj_RandomStreams(object):
+    def __init__(self, seed):
+        self.seed = seed
+        self.streams = {}
+        for name in STREAMS:
+            self.streams[name] = random.Random(derive_seed(seed, name))
+
+    def stream(self, name):
+        return self.streams[name]
+
+    # a separate generator that only depends on the game seed and the keys,
+    # e.g. for one level, so levels can be made in any order and in any process
+    def derive(self, name, *keys):
+        return random.Random(derive_seed(self.seed, name, *keys))
+
+    def randint(self, name, low, high):
+        return self.streams[name].randint(low, high)
+
+    def choice(self, name, seq):
+        return self.streams[name].choice(seq)
+
+    # count numbers with low <= N <= high in one go, as an array
+    # cheaper than calling randint() count times
+    def draw(self, name, count, low, high):
+        rand = self.streams[name].random
+        span = high - low + 1
+        return array('i', [low + int(rand() * span) for i in xrange(count)])
+
+    # dice rolls, e.g. rolls('combat', 3, 6) for 3d6
+    def rolls(self, name, dice, sides):
+        return self.draw(name, dice, 1, sides)
+
+    def roll(self, name, dice, sides):
+        return sum(self.rolls(name, dice, sides))
+
+    # name -> state, for the save file
+    def get_state(self):
+        return dict((name, stream.getstate()) for name, stream in self.streams.items())
+
+    def set_state(self, states):
+        for name, state in states.items():
+            # streams from a newer version that we don't know about are dropped
+            if name in self.streams:
+                self.streams[name].setstate(state)
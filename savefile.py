@@ -0,0 +1,539 @@
+# coding: utf8
+# Binary save format
+#
+# A save is a small header followed by a (optionally compressed) stream of chunks.
+# Each chunk is a 4 byte tag, a 4 byte length and the payload, so the reader never needs
+# the whole file in memory and can skip chunks it doesn't know about.
+#
+# header: b"RLSV", version (uint16), compression (uint16)
+# chunks:
+#   MAPH  map width and height
+#   MAPT  a slice of packed tiles, one byte per tile: bit 0 blocked, bit 1 explored, bit 2 stairs down,
+#         bit 3 stairs up (version 6)
+#   ROOM  all rooms, as x1, y1, x2, y2
+#   ENTY  one entity on the map, with its components (and inventory, nested)
+#   PLYR  index of the player in the entity list
+#   MESG  one message
+#   FOVO  where the FOV was last computed from (version 2)
+#   FOVT  a slice of the FOV map, one byte per tile: bit 0 transparent, bit 1 walkable (version 2)
+#   LEVL  the game seed and the depth of the level (version 4)
+#   RNGS  the state of one random number stream (version 5)
+#   LVST  the other visited levels: the level store's file and where each level is in it (version 6)
+#   JRNL  the autosave journal segment that starts where this save ends (version 7)
+# version 3 adds the creature's speed to ENTY
+#   END   end of the save
+import os
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # Python 2 doesn't ship lzma
+    lzma = None
+
+from tilegrid import struct_TileGrid
+
+MAGIC = b"RLSV"
+SAVE_VERSION = 7
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSIONS = {
+    None: COMPRESSION_NONE,
+    'none': COMPRESSION_NONE,
+    'zlib': COMPRESSION_ZLIB,
+    'lzma': COMPRESSION_LZMA,
+}
+
+# how many tiles go in one MAPT chunk
+TILE_CHUNK = 65536
+READ_BLOCK = 65536
+
+# component flags of an entity record
+HAS_CREATURE = 1
+HAS_AI = 2
+HAS_CONTAINER = 4
+HAS_ITEM = 8
+HAS_EQUIPMENT = 16
+
+# how the entity's char is stored
+CHAR_CODEPOINT = 0
+CHAR_STRING = 1
+
+_HEADER = struct.Struct("<4sHH")
+_CHUNK = struct.Struct("<4sI")
+_MAP_HEADER = struct.Struct("<ii")
+_RECT = struct.Struct("<iiii")
+_ENTITY = struct.Struct("<iiB")
+_CREATURE = struct.Struct("<iiHHi")
+_EQUIPMENT = struct.Struct("<BHHii")
+_FLOAT = struct.Struct("<d")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_FOV_ORIGIN = struct.Struct("<iiiBi")
+_LEVEL = struct.Struct("<qi")
+# depth, offset and length of a level in the level store
+_STORED_LEVEL = struct.Struct("<iQI")
+# state version, number of words, has gauss_next, gauss_next
+_RNG_HEADER = struct.Struct("<HIBd")
+
+# bit masks for unpacking the packed tile layers with translate()
+_BIT_TABLES = [bytes(bytearray([1 if value & bit else 0 for value in range(256)])) for bit in (1, 2, 4)]
+# bits 2 and 3 back to the stairs layer's STAIRS_DOWN/STAIRS_UP
+_STAIRS_TABLE = bytes(bytearray([(value >> 2) & 3 for value in range(256)]))
+
+
+class SaveFormatError(Exception):
+    pass
+
+
+# Writing
+class obj_SaveWriter(object):
+    def __init__(self, save_file, compression='zlib'):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression " + str(compression))
+        method = COMPRESSIONS[compression]
+        if method == COMPRESSION_LZMA and lzma is None:
+            raise ValueError("lzma is not available in this Python")
+
+        self.file = save_file
+        self.file.write(_HEADER.pack(MAGIC, SAVE_VERSION, method))
+
+        if method == COMPRESSION_ZLIB:
+            self.compressor = zlib.compressobj()
+        elif method == COMPRESSION_LZMA:
+            self.compressor = lzma.LZMACompressor()
+        else:
+            self.compressor = None
+
+    def _write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(bytes(data))
+        if data:
+            self.file.write(data)
+
+    def chunk(self, tag, payload):
+        self._write(_CHUNK.pack(tag, len(payload)))
+        self._write(payload)
+
+    def close(self):
+        self.chunk(b"END ", b"")
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+
+
+def pack_str(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return _U16.pack(len(text)) + text
+
+
+def pack_tiles(grid, start, end):
+    block, explored, stairs = grid.block_path, grid.explored, grid.stairs
+    return bytearray((block[i] and 1) | (explored[i] and 2) | (stairs[i] << 2) for i in range(start, end))
+
+
+# the other way round, returns where the next slice starts
+def unpack_tiles(grid, packed, start=0):
+    end = start + len(packed)
+    for layer, table in zip((grid.block_path, grid.explored, grid.stairs), (_BIT_TABLES[0], _BIT_TABLES[1],
+                                                                            _STAIRS_TABLE)):
+        layer[start:end] = packed.translate(table)
+    return end
+
+
+# one stream of the game's random numbers, as returned by random.Random.getstate()
+def pack_rng(name, state):
+    version, internal, gauss_next = state
+    has_gauss = gauss_next is not None
+    return (pack_str(name) + _RNG_HEADER.pack(version, len(internal), has_gauss, gauss_next if has_gauss else 0.0) +
+            struct.pack("<%dI" % len(internal), *internal))
+
+
+def unpack_rng(cursor):
+    name = cursor.string()
+    version, count, has_gauss, gauss_next = cursor.unpack(_RNG_HEADER)
+    internal = struct.unpack("<%dI" % count, cursor.read(4 * count))
+    return name, (version, internal, gauss_next if has_gauss else None)
+
+
+def pack_entity(ent):
+    flags = 0
+    parts = []
+
+    if ent.creature:
+        flags |= HAS_CREATURE
+        creature = ent.creature
+        parts.append(pack_str(creature.name_instance))
+        parts.append(_CREATURE.pack(creature.max_hp, creature.hp, creature.num_dice, creature.damage_dice,
+                                    creature.base_def))
+        parts.append(pack_str(_func_name(creature.death_function)))
+        parts.append(_U16.pack(creature.speed))
+
+    if ent.ai:
+        flags |= HAS_AI
+        parts.append(pack_str(type(ent.ai).__name__))
+
+    if ent.container:
+        flags |= HAS_CONTAINER
+        parts.append(_U32.pack(len(ent.container.inventory)))
+        for item in ent.container.inventory:
+            packed = pack_entity(item)
+            parts.append(_U32.pack(len(packed)))
+            parts.append(packed)
+
+    if ent.item:
+        flags |= HAS_ITEM
+        parts.append(_FLOAT.pack(ent.item.weight))
+        parts.append(pack_str(_func_name(ent.item.use_function)))
+
+    if ent.equipment:
+        flags |= HAS_EQUIPMENT
+        equipment = ent.equipment
+        parts.append(pack_str(equipment.slot))
+        parts.append(_EQUIPMENT.pack(1 if equipment.equipped else 0, equipment.num_dice, equipment.damage_dice,
+                                     equipment.attack_bonus, equipment.defense_bonus))
+
+    if isinstance(ent.char, int):
+        char = _U32.pack(CHAR_CODEPOINT) + _U32.pack(ent.char)
+    else:
+        char = _U32.pack(CHAR_STRING) + pack_str(ent.char)
+
+    return _ENTITY.pack(ent.x, ent.y, flags) + char + pack_str(ent.name) + b"".join(parts)
+
+
+def pack_fov(transparent, walkable, start, end):
+    return bytearray((transparent[i] and 1) | (walkable[i] and 2) for i in range(start, end))
+
+
+def _func_name(func):
+    if func is None:
+        return ""
+    return func.__name__
+
+
+# Everything a save needs, copied out of the running game
+# Taking one is cheap (copies of the tile layers, the entities already packed), the slow part
+# (packing the tiles, compressing, the disk) is write_image, which can then run on another thread
+class struct_SaveImage(object):
+    def __init__(self):
+        self.grid = None
+        self.rooms = []
+        self.seed = None
+        self.depth = 1
+        self.rng_states = {}
+        self.level_store_path = None
+        self.level_index = None
+        # packed entities, and which one is the player
+        self.entities = []
+        self.player_index = None
+        self.messages = []
+        self.fov_origin = None
+        self.fov_transparent = None
+        self.fov_walkable = None
+        # the autosave journal segment that goes on from this save (see autosave.py), None without one
+        self.journal_seq = None
+
+
+# the level store (if any) is flushed to its own file, the save only says where the levels are in it
+def capture_game(game, player, fov_map=None, level_store=None, compact_levels=True):
+    image = struct_SaveImage()
+    image.grid = game.current_map.copy()
+    image.rooms = [(room.x1, room.y1, room.x2, room.y2) for room in game.current_rooms]
+    image.seed = game.seed
+    image.depth = game.depth
+    image.rng_states = game.rng.get_state()
+    if level_store is not None:
+        # compacting moves the levels to another file, so the path is only known afterwards
+        image.level_index = level_store.flush(compact_levels)
+        image.level_store_path = level_store.path
+
+    image.entities = [pack_entity(ent) for ent in game.current_entities]
+    image.player_index = game.current_entities.index(player)
+    image.messages = list(game.message_history)
+
+    if fov_map is not None:
+        image.fov_origin = fov_map.origin
+        image.fov_transparent = bytes(fov_map.transparent)
+        image.fov_walkable = bytes(fov_map.walkable)
+    return image
+
+
+def write_image(save_file, image, compression='zlib'):
+    writer = obj_SaveWriter(save_file, compression)
+
+    grid = image.grid
+    writer.chunk(b"MAPH", _MAP_HEADER.pack(grid.width, grid.height))
+    size = grid.width * grid.height
+    for start in range(0, size, TILE_CHUNK):
+        writer.chunk(b"MAPT", pack_tiles(grid, start, min(start + TILE_CHUNK, size)))
+
+    writer.chunk(b"ROOM", b"".join(_RECT.pack(*room) for room in image.rooms))
+    writer.chunk(b"LEVL", _LEVEL.pack(image.seed, image.depth))
+    for name, state in sorted(image.rng_states.items()):
+        writer.chunk(b"RNGS", pack_rng(name, state))
+    if image.level_index is not None:
+        index = image.level_index
+        writer.chunk(b"LVST", pack_str(image.level_store_path) + _U32.pack(len(index)) +
+                     b"".join(_STORED_LEVEL.pack(depth, offset, length)
+                              for depth, (offset, length) in sorted(index.items())))
+    if image.journal_seq is not None:
+        writer.chunk(b"JRNL", _U32.pack(image.journal_seq))
+
+    for packed in image.entities:
+        writer.chunk(b"ENTY", packed)
+    writer.chunk(b"PLYR", _U32.pack(image.player_index))
+
+    for msg, color in image.messages:
+        writer.chunk(b"MESG", pack_str(msg) + pack_str(color))
+
+    if image.fov_transparent is not None:
+        if image.fov_origin is not None:
+            x, y, radius, light_walls, algo = image.fov_origin
+            writer.chunk(b"FOVO", _FOV_ORIGIN.pack(x, y, radius, 1 if light_walls else 0, algo))
+        for start in range(0, size, TILE_CHUNK):
+            writer.chunk(b"FOVT", pack_fov(image.fov_transparent, image.fov_walkable, start,
+                                           min(start + TILE_CHUNK, size)))
+
+    writer.close()
+
+
+def write_game(save_file, game, player, compression='zlib', fov_map=None, level_store=None):
+    write_image(save_file, capture_game(game, player, fov_map, level_store), compression)
+
+
+def replace_file(source, target):
+    try:
+        os.replace(source, target)
+    except AttributeError:
+        # Python 2: rename replaces the target in one go, except on Windows where it refuses to
+        try:
+            os.rename(source, target)
+        except OSError:
+            os.remove(target)
+            os.rename(source, target)
+
+
+# A save that is either all there or not at all: written next to the old one, then moved over it
+def write_save_file(path, image, compression='zlib'):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as save_file:
+        write_image(save_file, image, compression)
+        save_file.flush()
+        os.fsync(save_file.fileno())
+    replace_file(temp_path, path)
+
+
+# Reading
+class obj_SaveReader(object):
+    def __init__(self, save_file):
+        self.file = save_file
+        header = save_file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise SaveFormatError("Save file is too short")
+        magic, self.version, method = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SaveFormatError("Not a save file")
+        if self.version > SAVE_VERSION:
+            raise SaveFormatError("Save file version " + str(self.version) + " is newer than this game")
+
+        if method == COMPRESSION_ZLIB:
+            self.decompressor = zlib.decompressobj()
+        elif method == COMPRESSION_LZMA:
+            if lzma is None:
+                raise SaveFormatError("Save file is lzma compressed, but lzma is not available")
+            self.decompressor = lzma.LZMADecompressor()
+        else:
+            self.decompressor = None
+        self.buffer = bytearray()
+
+    def _read(self, size):
+        while len(self.buffer) < size:
+            block = self.file.read(READ_BLOCK)
+            if not block:
+                raise SaveFormatError("Save file ends unexpectedly")
+            if self.decompressor is not None:
+                block = self.decompressor.decompress(block)
+            self.buffer += block
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def chunks(self):
+        while True:
+            tag, length = _CHUNK.unpack(self._read(_CHUNK.size))
+            if tag == b"END ":
+                return
+            yield tag, self._read(length)
+
+
+# walks through a chunk payload
+class struct_Cursor(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def read(self, size):
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def string(self):
+        length, = self.unpack(_U16)
+        text = self.read(length).decode('utf-8')
+        if str is bytes:
+            # Python 2: keep plain str
+            text = text.encode('utf-8')
+        return text
+
+
+def unpack_entity(cursor, registry, version=SAVE_VERSION):
+    x, y, flags = cursor.unpack(_ENTITY)
+    char_kind, = cursor.unpack(_U32)
+    if char_kind == CHAR_CODEPOINT:
+        char, = cursor.unpack(_U32)
+    else:
+        char = cursor.string()
+    name = cursor.string()
+
+    creature = ai = container = item = equipment = None
+
+    if flags & HAS_CREATURE:
+        name_instance = cursor.string()
+        max_hp, hp, num_dice, damage_dice, base_def = cursor.unpack(_CREATURE)
+        death_function = _lookup(registry, cursor.string())
+        creature = registry['com_Creature'](name_instance, num_dice, damage_dice, base_def, max_hp, death_function)
+        creature.hp = hp
+        if version >= 3:
+            creature.speed, = cursor.unpack(_U16)
+
+    if flags & HAS_AI:
+        ai = _lookup(registry, cursor.string())()
+
+    if flags & HAS_CONTAINER:
+        count, = cursor.unpack(_U32)
+        inventory = []
+        for i in range(count):
+            length, = cursor.unpack(_U32)
+            inventory.append(unpack_entity(struct_Cursor(cursor.read(length)), registry, version))
+        container = registry['com_Container'](inventory)
+
+    if flags & HAS_ITEM:
+        weight, = cursor.unpack(_FLOAT)
+        item = registry['com_Item'](weight, _lookup(registry, cursor.string()))
+
+    if flags & HAS_EQUIPMENT:
+        slot = cursor.string()
+        equipped, num_dice, damage_dice, attack_bonus, defense_bonus = cursor.unpack(_EQUIPMENT)
+        equipment = registry['com_Equipment'](slot, num_dice, damage_dice, attack_bonus, defense_bonus)
+        equipment.equipped = equipped != 0
+
+    ent = registry['obj_Entity'](x, y, char, name, creature=creature, ai=ai, container=container,
+                                 item=item, equipment=equipment)
+
+    # items know which container they're in
+    if container:
+        for inv_item in container.inventory:
+            if inv_item.item:
+                inv_item.item.current_container = container
+    return ent
+
+
+def _lookup(registry, name):
+    if not name:
+        return None
+    if name not in registry:
+        raise SaveFormatError("Save file refers to unknown " + name)
+    return registry[name]
+
+
+# everything read from a save, main.load_game puts it together
+class struct_SaveData(object):
+    def __init__(self):
+        self.version = None
+        self.current_map = None
+        self.current_rooms = []
+        self.entities = []
+        self.player_index = None
+        self.messages = []
+        # None for saves from before the FOV map was saved
+        self.fov_transparent = None
+        self.fov_walkable = None
+        self.fov_origin = None
+        # None for saves from before levels came from a seed, the game picks a new one
+        self.game_seed = None
+        self.depth = 1
+        # name -> random.Random state
+        self.rng_states = {}
+        # None for saves from before the level store, otherwise depth -> (offset, length) in level_store_path
+        self.level_store_path = None
+        self.level_index = None
+        # None for saves that have no journal after them
+        self.journal_seq = None
+
+
+# registry maps class and function names used in the save to the actual objects
+def read_game(save_file, registry):
+    reader = obj_SaveReader(save_file)
+    data = struct_SaveData()
+    data.version = reader.version
+    tile_offset = 0
+    fov_offset = 0
+
+    for tag, payload in reader.chunks():
+        if tag == b"MAPH":
+            width, height = _MAP_HEADER.unpack(payload)
+            data.current_map = struct_TileGrid(width, height)
+        elif tag == b"MAPT":
+            tile_offset = unpack_tiles(data.current_map, payload, tile_offset)
+        elif tag == b"ROOM":
+            for offset in range(0, len(payload), _RECT.size):
+                x1, y1, x2, y2 = _RECT.unpack_from(payload, offset)
+                data.current_rooms.append(registry['Rect'](x1, y1, x2 - x1, y2 - y1))
+        elif tag == b"LEVL":
+            data.game_seed, data.depth = _LEVEL.unpack(payload)
+        elif tag == b"RNGS":
+            name, state = unpack_rng(struct_Cursor(payload))
+            data.rng_states[name] = state
+        elif tag == b"LVST":
+            cursor = struct_Cursor(payload)
+            data.level_store_path = cursor.string()
+            count, = cursor.unpack(_U32)
+            data.level_index = {}
+            for i in range(count):
+                depth, offset, length = cursor.unpack(_STORED_LEVEL)
+                data.level_index[depth] = (offset, length)
+        elif tag == b"JRNL":
+            data.journal_seq, = _U32.unpack(payload)
+        elif tag == b"ENTY":
+            data.entities.append(unpack_entity(struct_Cursor(payload), registry, reader.version))
+        elif tag == b"PLYR":
+            data.player_index, = _U32.unpack(payload)
+        elif tag == b"MESG":
+            cursor = struct_Cursor(payload)
+            msg = cursor.string()
+            data.messages.append((msg, cursor.string()))
+        elif tag == b"FOVO":
+            x, y, radius, light_walls, algo = _FOV_ORIGIN.unpack(payload)
+            data.fov_origin = (x, y, radius, light_walls != 0, algo)
+        elif tag == b"FOVT":
+            if data.fov_transparent is None:
+                size = len(data.current_map.block_path)
+                data.fov_transparent = bytearray(size)
+                data.fov_walkable = bytearray(size)
+            end = fov_offset + len(payload)
+            data.fov_transparent[fov_offset:end] = payload.translate(_BIT_TABLES[0])
+            data.fov_walkable[fov_offset:end] = payload.translate(_BIT_TABLES[1])
+            fov_offset = end
+        # unknown chunks are from a newer minor version, skip them
+
+    if data.current_map is None or data.player_index is None:
+        raise SaveFormatError("Save file is missing the map or the player")
+    return data
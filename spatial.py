@@ -0,0 +1,141 @@
+# coding: utf8
+import math
+
+# Spatial hash of entities keyed by their cell
+# Entities report their own moves (see obj_Entity.x/y in main.py), so lookups never scan the entity list
+class obj_SpatialIndex(object):
+    def __init__(self):
+        self.cells = {}
+        # optional callback(x, y), called whenever the occupants of a cell change (used by the renderer)
+        self.listener = None
+
+    def __len__(self):
+        return sum(len(cell) for cell in self.cells.values())
+
+    def clear(self):
+        for (x, y), cell in self.cells.items():
+            for ent in cell:
+                ent.spatial_index = None
+            if self.listener is not None:
+                self.listener(x, y)
+        self.cells = {}
+
+    def rebuild(self, entities):
+        self.clear()
+        for ent in entities:
+            self.add(ent)
+
+    def add(self, ent):
+        if ent.spatial_index is not None:
+            ent.spatial_index.remove(ent)
+        ent.spatial_index = self
+        key = (ent.x, ent.y)
+        cell = self.cells.get(key)
+        if cell is None:
+            self.cells[key] = [ent]
+        else:
+            cell.append(ent)
+        if self.listener is not None:
+            self.listener(ent.x, ent.y)
+
+    def remove(self, ent):
+        self._discard(ent, ent.x, ent.y)
+        ent.spatial_index = None
+
+    # called by the entity whenever its position changes
+    def move(self, ent, old_x, old_y, new_x, new_y):
+        self._discard(ent, old_x, old_y)
+        key = (new_x, new_y)
+        cell = self.cells.get(key)
+        if cell is None:
+            self.cells[key] = [ent]
+        else:
+            cell.append(ent)
+        if self.listener is not None:
+            self.listener(new_x, new_y)
+
+    def _discard(self, ent, x, y):
+        cell = self.cells.get((x, y))
+        if cell is not None and ent in cell:
+            cell.remove(ent)
+            if not cell:
+                del self.cells[(x, y)]
+            if self.listener is not None:
+                self.listener(x, y)
+
+    # queries
+    def at(self, x, y):
+        return self.cells.get((x, y), ())
+
+    def in_radius(self, x, y, radius, filter_func=None):
+        # visit whichever is smaller: the cells of the bounding square or the occupied cells
+        found = []
+        r = int(math.ceil(radius))
+        radius_sq = radius * radius
+        if (2 * r + 1) ** 2 <= len(self.cells):
+            for cx in range(x - r, x + r + 1):
+                for cy in range(y - r, y + r + 1):
+                    cell = self.cells.get((cx, cy))
+                    if cell is not None and (cx - x) ** 2 + (cy - y) ** 2 <= radius_sq:
+                        found.extend(cell)
+        else:
+            for (cx, cy), cell in self.cells.items():
+                if (cx - x) ** 2 + (cy - y) ** 2 <= radius_sq:
+                    found.extend(cell)
+
+        if filter_func is not None:
+            found = [ent for ent in found if filter_func(ent)]
+        return found
+
+    def nearest(self, x, y, k=1, max_distance=None, filter_func=None):
+        # returns up to k (distance, entity) pairs sorted by distance
+        # we walk outwards ring by ring (a ring is all cells at the same chessboard distance);
+        # every cell in ring r is at least r away, so once we have k hits closer than r we can stop
+        found = []
+        r = 0
+        while True:
+            if max_distance is not None and r > max_distance:
+                break
+            # the ring got bigger than the number of occupied cells, just check all of them
+            if 8 * r > len(self.cells):
+                found = self._nearest_brute(x, y, filter_func)
+                break
+
+            for cx, cy in _ring(x, y, r):
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    continue
+                for ent in cell:
+                    if filter_func is None or filter_func(ent):
+                        found.append((math.sqrt((cx - x) ** 2 + (cy - y) ** 2), ent))
+
+            if len(found) >= k:
+                found.sort(key=lambda pair: pair[0])
+                if found[k - 1][0] <= r + 1:
+                    break
+            r += 1
+
+        found.sort(key=lambda pair: pair[0])
+        if max_distance is not None:
+            found = [pair for pair in found if pair[0] <= max_distance]
+        return found[:k]
+
+    def _nearest_brute(self, x, y, filter_func):
+        found = []
+        for (cx, cy), cell in self.cells.items():
+            for ent in cell:
+                if filter_func is None or filter_func(ent):
+                    found.append((math.sqrt((cx - x) ** 2 + (cy - y) ** 2), ent))
+        return found
+
+
+def _ring(x, y, r):
+    if r == 0:
+        yield x, y
+        return
+    for cx in range(x - r, x + r + 1):
+        yield cx, y - r
+        yield cx, y + r
+    for cy in range(y - r + 1, y + r):
+        yield x - r, cy
+        yield x + r, cy
@@ -0,0 +1,94 @@
+# coding: utf8
+# python -m unittest test_visibility (needs libtcod, like the game)
+import random
+import unittest
+
+from tilegrid import struct_TileGrid
+from visibility import obj_Visibility
+
+RADIUS = 8
+
+
+def scattered_walls(seed, size=24):
+    grid = struct_TileGrid(size, size, block_path=False)
+    rand = random.Random(seed)
+    for i in range(size * size // 5):
+        grid.set_blocked(rand.randint(0, size - 1), rand.randint(0, size - 1), True)
+    return grid
+
+
+class VisibilityTest(unittest.TestCase):
+    def check_symmetric(self, seed):
+        grid = scattered_walls(seed)
+        vis = obj_Visibility(grid, cache_size=1000)
+        rand = random.Random(seed)
+        free = [grid.coords(index) for index in grid.free_indices()]
+        pairs = [(rand.choice(free), rand.choice(free)) for i in range(300)]
+
+        def answers():
+            return [(vis.can_see(a[0], a[1], b[0], b[1], RADIUS), vis.can_see(b[0], b[1], a[0], a[1], RADIUS))
+                    for a, b in pairs]
+
+        empty = answers()
+        # half full: only one end of every pair has a FOV
+        for a, b in pairs:
+            vis.visible_from(a[0], a[1], RADIUS)
+        half = answers()
+        # full: both ends do
+        for a, b in pairs:
+            vis.visible_from(b[0], b[1], RADIUS)
+        full = answers()
+
+        # every answer is the plain line check, whatever was cached
+        expected = [vis.line_of_sight(a[0], a[1], b[0], b[1]) or vis.line_of_sight(b[0], b[1], a[0], a[1])
+                    for a, b in pairs]
+        expected = [see and (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 <= RADIUS * RADIUS
+                    for see, (a, b) in zip(expected, pairs)]
+        for state in (empty, half, full):
+            self.assertEqual([forward for forward, backward in state], expected)
+            self.assertEqual([backward for forward, backward in state], expected)
+
+    def test_can_see_is_symmetric(self):
+        for seed in range(5):
+            self.check_symmetric(seed)
+
+    def test_cache_hit(self):
+        grid = scattered_walls(7)
+        vis = obj_Visibility(grid)
+        visible = vis.visible_from(12, 12, RADIUS)
+        self.assertEqual((vis.hits, vis.misses), (0, 1))
+        self.assertIs(vis.cached(12, 12, RADIUS), visible)
+        # asking about (12, 12) from anywhere is answered from its result
+        for index in grid.free_indices():
+            x, y = grid.coords(index)
+            vis.can_see(x, y, 12, 12, RADIUS)
+        self.assertEqual(vis.misses, 1)
+        self.assertTrue(vis.hits > 0)
+
+    def test_tile_change_invalidates(self):
+        grid = struct_TileGrid(20, 20, block_path=False)
+        vis = obj_Visibility(grid)
+        self.assertTrue(vis.can_see(2, 2, 6, 2, RADIUS))
+        far = vis.visible_from(19, 19, 2)
+        # a wall between the two drops the result around it, and only that one
+        grid.set_blocked(4, 2, True)
+        self.assertIsNone(vis.cached(6, 2, RADIUS))
+        self.assertIs(vis.cached(19, 19, 2), far)
+        self.assertFalse(vis.can_see(2, 2, 6, 2, RADIUS))
+        self.assertFalse(vis.can_see(6, 2, 2, 2, RADIUS))
+        grid.set_blocked(4, 2, False)
+        self.assertTrue(vis.can_see(6, 2, 2, 2, RADIUS))
+
+    def test_walls_block(self):
+        grid = struct_TileGrid(10, 10, block_path=False)
+        for y in range(10):
+            grid.set_blocked(5, y, True)
+        vis = obj_Visibility(grid)
+        self.assertFalse(vis.can_see(2, 2, 8, 2, RADIUS))
+        self.assertFalse(vis.can_see(8, 2, 2, 2, RADIUS))
+        self.assertTrue(vis.can_see(2, 2, 4, 6, RADIUS))
+        self.assertTrue(vis.can_see(4, 6, 2, 2, RADIUS))
+
+
+if __name__ == '__main__':
+    unittest.main()
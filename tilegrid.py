@@ -0,0 +1,306 @@
+# coding: utf8
+import itertools
+from array import array
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+# The map used to be a list of lists of struct_Tile objects, which costs hundreds of bytes per tile
+# Here every tile attribute is a packed layer (one byte per tile) so a tile costs a few bytes
+# Layers are stored column by column (index = x * height + y), so map[x] is one contiguous slice
+# and a rectangle is just one slice assignment per column
+
+LAYERS = ("block_path", "explored", "stairs")
+
+# what the stairs layer holds
+STAIRS_DOWN = 1
+STAIRS_UP = 2
+
+# translate() tables for building masks without a Python loop
+_NOT_TABLE = bytes(bytearray([1] + [0] * 255))
+_BOOL_TABLE = bytes(bytearray([0] + [1] * 255))
+
+
+# Needed for map
+# this is a view into the grid, so that the old map[x][y].block_path code keeps working
+class struct_Tile(object):
+    __slots__ = ("grid", "index")
+
+    def __init__(self, grid, index):
+        self.grid = grid
+        self.index = index
+
+    @property
+    def block_path(self):
+        return self.grid.block_path[self.index] != 0
+
+    @block_path.setter
+    def block_path(self, value):
+        self.grid.set_blocked_index(self.index, value)
+
+    @property
+    def explored(self):
+        return self.grid.explored[self.index] != 0
+
+    @explored.setter
+    def explored(self, value):
+        self.grid.explored[self.index] = 1 if value else 0
+
+    @property
+    def stairs(self):
+        return self.grid.stairs[self.index] != 0
+
+    @stairs.setter
+    def stairs(self, value):
+        self.grid.stairs[self.index] = 1 if value else 0
+
+
+class struct_TileColumn(object):
+    __slots__ = ("grid", "x")
+
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+
+    def __len__(self):
+        return self.grid.height
+
+    def __getitem__(self, y):
+        if not 0 <= y < self.grid.height:
+            raise IndexError("map y out of range")
+        return struct_Tile(self.grid, self.x * self.grid.height + y)
+
+
+class struct_TileGrid(object):
+    def __init__(self, width, height, block_path=True):
+        self.width = width
+        self.height = height
+        size = width * height
+        self.block_path = bytearray([1 if block_path else 0]) * size
+        self.explored = bytearray(size)
+        self.stairs = bytearray(size)
+        # free cell index, see free_index()
+        self._free = None
+        self._free_pos = None
+        # callbacks(indices) called with the cells whose block_path changed (e.g. to keep FOV in sync)
+        self.listeners = []
+
+    # map[x][y] access for the old code
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, x):
+        if not 0 <= x < self.width:
+            raise IndexError("map x out of range")
+        return struct_TileColumn(self, x)
+
+    def __getstate__(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'block_path': bytes(self.block_path),
+            'explored': bytes(self.explored),
+            'stairs': bytes(self.stairs),
+        }
+
+    def __setstate__(self, state):
+        self.width = state['width']
+        self.height = state['height']
+        for name in LAYERS:
+            setattr(self, name, bytearray(state[name]))
+        self._free = None
+        self._free_pos = None
+        self.listeners = []
+
+    # the tiles only, without the free cell index or listeners
+    def copy(self):
+        grid = struct_TileGrid.__new__(struct_TileGrid)
+        grid.__setstate__(self.__getstate__())
+        return grid
+
+    def index(self, x, y):
+        return x * self.height + y
+
+    def coords(self, index):
+        return divmod(index, self.height)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def is_blocked(self, x, y):
+        return self.block_path[x * self.height + y] != 0
+
+    def is_explored(self, x, y):
+        return self.explored[x * self.height + y] != 0
+
+    def is_stairs(self, x, y):
+        return self.stairs[x * self.height + y] != 0
+
+    # STAIRS_DOWN, STAIRS_UP or 0
+    def stairs_at(self, x, y):
+        return self.stairs[x * self.height + y]
+
+    # where the first stairs of a kind are, or None
+    def find_stairs(self, kind=STAIRS_DOWN):
+        index = self.stairs.find(bytearray([kind]))
+        if index < 0:
+            return None
+        return self.coords(index)
+
+    def set_blocked(self, x, y, value):
+        self.set_blocked_index(x * self.height + y, value)
+
+    def set_blocked_index(self, index, value):
+        new = 1 if value else 0
+        if self.block_path[index] == new:
+            return
+        self.block_path[index] = new
+        if self._free is not None:
+            if new:
+                self._free_remove(index)
+            else:
+                self._free_add(index)
+        for listener in self.listeners:
+            listener((index,))
+
+    def set_explored(self, x, y, value=True):
+        self.explored[x * self.height + y] = 1 if value else 0
+
+    def set_stairs(self, x, y, value=True, kind=STAIRS_DOWN):
+        self.stairs[x * self.height + y] = kind if value else 0
+
+    # bulk operations
+    def fill_rect(self, layer, x1, y1, x2, y2, value):
+        # fills [x1, x2) x [y1, y2), clipped to the map, one slice per column (or row)
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, self.width), min(y2, self.height)
+        if x1 >= x2 or y1 >= y2:
+            return
+        data = getattr(self, layer)
+        # the free cell index and the listeners need to know which cells actually change
+        track = layer == "block_path" and (self._free is not None or self.listeners)
+        changed_table = _NOT_TABLE if value else _BOOL_TABLE
+        changed = []
+
+        height = self.height
+        if x2 - x1 > y2 - y1:
+            # wider than tall (e.g. a horizontal corridor): a row is every height-th byte,
+            # so it's one extended slice per row instead of a slice per column
+            length = x2 - x1
+            lines = ((x1 * height + y, height) for y in xrange(y1, y2))
+        else:
+            length = y2 - y1
+            lines = ((x * height + y1, 1) for x in xrange(x1, x2))
+        fill = bytearray([1 if value else 0]) * length
+
+        for start, step in lines:
+            stop = start + (length - 1) * step + 1
+            if track:
+                old = bytes(data[start:stop:step])
+                changed.extend(start + offset * step for offset in
+                               itertools.compress(xrange(length), bytearray(old.translate(changed_table))))
+            data[start:stop:step] = fill
+
+        if changed:
+            if self._free is not None:
+                for index in changed:
+                    if value:
+                        self._free_remove(index)
+                    else:
+                        self._free_add(index)
+            for listener in self.listeners:
+                listener(changed)
+
+    def carve_rect(self, x1, y1, x2, y2):
+        self.fill_rect("block_path", x1, y1, x2, y2, False)
+
+    def mask(self, layer, value=True):
+        # a copy of the layer with 1 where the layer equals value
+        if value:
+            return bytearray(bytes(getattr(self, layer)).translate(_BOOL_TABLE))
+        return bytearray(bytes(getattr(self, layer)).translate(_NOT_TABLE))
+
+    def walkable_mask(self):
+        return self.mask("block_path", False)
+
+    def free_indices(self):
+        # compress() walks the mask in C, so there is no per-tile Python code
+        return list(itertools.compress(xrange(len(self.block_path)), self.walkable_mask()))
+
+    def free_cells(self):
+        height = self.height
+        return [divmod(i, height) for i in self.free_indices()]
+
+    # Free cell index
+    # a list of free cell indices plus the position of each cell in that list,
+    # so that adding, removing and picking a random free cell are all O(1)
+    # It's built the first time it's needed and then kept up to date as tiles get carved or blocked
+    def free_index(self):
+        if self._free is None:
+            self._free = array('i', self.free_indices())
+            self._free_pos = array('i', [-1]) * len(self.block_path)
+            free_pos = self._free_pos
+            for pos, index in enumerate(self._free):
+                free_pos[index] = pos
+        return self._free
+
+    def _free_add(self, index):
+        self._free_pos[index] = len(self._free)
+        self._free.append(index)
+
+    def _free_remove(self, index):
+        # move the last entry into the hole
+        pos = self._free_pos[index]
+        last = self._free.pop()
+        if last != index:
+            self._free[pos] = last
+            self._free_pos[last] = pos
+        self._free_pos[index] = -1
+
+    def _free_swap(self, pos_a, pos_b):
+        free, free_pos = self._free, self._free_pos
+        a, b = free[pos_a], free[pos_b]
+        free[pos_a], free[pos_b] = b, a
+        free_pos[b], free_pos[a] = pos_a, pos_b
+
+    def free_count(self):
+        return len(self.free_index())
+
+    # randint(a, b) returns a random integer with a <= N <= b
+    # exclude(x, y) can reject cells, e.g. ones with an entity on them
+    def random_free_cell(self, randint, exclude=None, tries=16):
+        free = self.free_index()
+        if not free:
+            return None
+        for i in xrange(tries):
+            x, y = divmod(free[randint(0, len(free) - 1)], self.height)
+            if exclude is None or not exclude(x, y):
+                return x, y
+        # mostly excluded cells, fall back to going through them all
+        found = self.sample_free_cells(1, randint, exclude)
+        if found:
+            return found[0]
+        return None
+
+    # up to count different free cells
+    def sample_free_cells(self, count, randint, exclude=None):
+        # partial Fisher-Yates shuffle of the free list, the list order doesn't matter to anyone else
+        free = self.free_index()
+        height = self.height
+        found = []
+        pos = 0
+        while len(found) < count and pos < len(free):
+            self._free_swap(pos, randint(pos, len(free) - 1))
+            x, y = divmod(free[pos], height)
+            if exclude is None or not exclude(x, y):
+                found.append((x, y))
+            pos += 1
+        return found
+
+    def count(self, layer, value=True):
+        zeroes = getattr(self, layer).count(b"\x00")
+        if value:
+            return len(getattr(self, layer)) - zeroes
+        return zeroes
@@ -0,0 +1,137 @@
+# coding: utf8
+import heapq
+
+import constants
+from components import STORE
+from profiler import profiled
+
+
+# Decides who acts when
+# Only actors (entities with an AI) are in here, ordered by the time of their next turn
+# A creature with speed 200 acts twice as often as one with the normal speed of 100
+# Actors far away from the player fall asleep and stop taking turns until something wakes them up
+class obj_TurnScheduler(object):
+    def __init__(self, entity_index):
+        self.entity_index = entity_index
+        self.time = 0
+        self.queue = []
+        # tie breaker, so actors with the same time act in the order they were scheduled
+        self.counter = 0
+        # actor -> the counter of its live queue entry, any other entry of it is stale
+        self.scheduled = {}
+        self.dormant = set()
+
+        # stats of the last advance()
+        self.acted = 0
+        self.woken = 0
+        self.slept = 0
+        # and of all of them
+        self.ticks = 0
+        self.total_acted = 0
+
+    def __len__(self):
+        return len(self.scheduled) + len(self.dormant)
+
+    def add(self, ent, delay=None):
+        if ent.ai is None or ent in self.scheduled:
+            return
+        self.dormant.discard(ent)
+        if delay is None:
+            delay = action_delay(ent)
+        self._push(ent, self.time + delay)
+
+    def _push(self, ent, when):
+        self.counter += 1
+        heapq.heappush(self.queue, (when, self.counter, ent))
+        self.scheduled[ent] = self.counter
+
+    def remove(self, ent):
+        # the queue entry is skipped when it comes up, even if the actor is added back before that
+        self.scheduled.pop(ent, None)
+        self.dormant.discard(ent)
+
+    @staticmethod
+    def can_act(ent):
+        # dead monsters lose their AI, picked up or removed entities are no longer on the map
+        return ent.ai is not None and ent.creature is not None and ent.spatial_index is not None
+
+    def wake_near(self, x, y, radius):
+        if not self.dormant:
+            return 0
+        woken = 0
+        for ent in self.entity_index.in_radius(x, y, radius):
+            if ent in self.dormant:
+                self.dormant.discard(ent)
+                self._push(ent, self.time)
+                woken += 1
+        self.woken += woken
+        return woken
+
+    # something loud happened, e.g. a fight
+    def noise(self, x, y, radius=constants.NOISE_RADIUS):
+        return self.wake_near(x, y, radius)
+
+    # the player spent `delay` time on their action, now everyone whose turn comes up before that acts
+    @profiled('ai')
+    def advance(self, delay, player):
+        self.acted = 0
+        self.woken = 0
+        self.slept = 0
+        self.time += delay
+
+        self.wake_near(player.x, player.y, constants.WAKE_RADIUS)
+        far = self.far_away(player)
+
+        while self.queue and self.queue[0][0] <= self.time:
+            when, count, ent = heapq.heappop(self.queue)
+            if self.scheduled.get(ent) != count:
+                continue
+            del self.scheduled[ent]
+            if not self.can_act(ent):
+                continue
+
+            # an actor's first turn in here uses the distance worked out above,
+            # after that (it has moved) or when a noise woke it up in the meantime, ask should_sleep
+            is_far = far.pop(ent, None)
+            if is_far is None:
+                sleep = self.should_sleep(ent, player)
+            else:
+                sleep = is_far and not getattr(ent.ai, 'chasing', False)
+            if sleep:
+                self.dormant.add(ent)
+                self.slept += 1
+                continue
+
+            ent.ai.take_turn()
+            self.acted += 1
+
+            # the turn may have killed it
+            if self.can_act(ent):
+                self._push(ent, when + action_delay(ent))
+
+        self.ticks += 1
+        self.total_acted += self.acted
+        return self.acted
+
+    # actor -> whether it is out of WAKE_RADIUS of the player, for everyone in the queue
+    # One pass over the position columns, most of the actors on a big level are far away and go straight to sleep
+    def far_away(self, player):
+        actors = list(self.scheduled)
+        xs, ys = STORE.positions(actors)
+        px, py = player.x, player.y
+        limit = constants.WAKE_RADIUS * constants.WAKE_RADIUS
+        return dict((ent, (x - px) * (x - px) + (y - py) * (y - py) > limit) for ent, x, y in zip(actors, xs, ys))
+
+    def should_sleep(self, ent, player):
+        if getattr(ent.ai, 'chasing', False):
+            return False
+        dx, dy = ent.x - player.x, ent.y - player.y
+        return dx * dx + dy * dy > constants.WAKE_RADIUS * constants.WAKE_RADIUS
+
+
+# how long an action takes for this entity
+def action_delay(ent):
+    speed = constants.NORMAL_SPEED
+    if ent.creature is not None and ent.creature.speed > 0:
+        speed = ent.creature.speed
+    return constants.ACTION_COST * constants.NORMAL_SPEED // speed
@@ -0,0 +1,133 @@
+# coding: utf8
+from collections import OrderedDict
+
+import constants
+
+
+class struct_SightResult(object):
+    __slots__ = ("x", "y", "radius", "visible")
+
+    def __init__(self, x, y, radius, visible):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        # set of cell indices that can see (x, y) and be seen from it
+        self.visible = visible
+
+
+# Answers "what can be seen from here" and "can A see B" for any number of creatures
+# Results are cached per (origin, radius); a tile change only drops the results whose radius covers it
+# Sight is symmetric: a cell is in the set of an origin when a line runs clear from either end,
+# so can_see gives the same answer whichever end's set it finds in the cache
+# (the player's libtcod FOV isn't symmetric, so it is only used for drawing and targeting, not kept in here)
+class obj_Visibility(object):
+    def __init__(self, grid, cache_size=constants.VISIBILITY_CACHE_SIZE):
+        self.grid = grid
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+        grid.listeners.append(self.tiles_changed)
+
+    def detach(self):
+        if self.tiles_changed in self.grid.listeners:
+            self.grid.listeners.remove(self.tiles_changed)
+
+    def tiles_changed(self, indices):
+        height = self.grid.height
+        cells = [divmod(index, height) for index in indices]
+        stale = [key for key, res in self.cache.items()
+                 if any(abs(cx - res.x) <= res.radius and abs(cy - res.y) <= res.radius for cx, cy in cells)]
+        for key in stale:
+            del self.cache[key]
+
+    def _radius(self, radius):
+        if radius <= 0:
+            return self.grid.width + self.grid.height
+        return radius
+
+    def _bounds(self, x, y, radius):
+        grid = self.grid
+        return max(0, x - radius), max(0, y - radius), min(grid.width, x + radius + 1), min(grid.height, y + radius + 1)
+
+    # the cells of the fov map in FOV, only looking at the square the light radius covers
+    def fov_cells(self, fov_map, x, y, radius):
+        height = self.grid.height
+        x1, y1, x2, y2 = self._bounds(x, y, self._radius(radius))
+        visible = set()
+        for cx in range(x1, x2):
+            for cy in range(y1, y2):
+                if fov_map.is_in_fov(cx, cy):
+                    visible.add(cx * height + cy)
+        return visible
+
+    def cached(self, x, y, radius):
+        res = self.cache.get((x, y, self._radius(radius)))
+        if res is None:
+            return None
+        return res.visible
+
+    def visible_from(self, x, y, radius=constants.LIGHT_RADIUS):
+        radius = self._radius(radius)
+        key = (x, y, radius)
+        res = self.cache.get(key)
+        if res is not None:
+            self.hits += 1
+            # the most recently used ones are at the end, the oldest get dropped first
+            del self.cache[key]
+            self.cache[key] = res
+            return res.visible
+
+        self.misses += 1
+        height = self.grid.height
+        x1, y1, x2, y2 = self._bounds(x, y, radius)
+        visible = set()
+        for cx in range(x1, x2):
+            for cy in range(y1, y2):
+                if ((cx - x) ** 2 + (cy - y) ** 2 <= radius * radius
+                        and (self.line_of_sight(x, y, cx, cy) or self.line_of_sight(cx, cy, x, y))):
+                    visible.add(cx * height + cy)
+
+        self.cache[key] = struct_SightResult(x, y, radius, visible)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return visible
+
+    # Can something at (ax, ay) see (bx, by)? The answer is the same both ways round
+    # Answered from whichever end has a cached result, or else b's is worked out:
+    # in the game b is the player, whom every monster asks about
+    def can_see(self, ax, ay, bx, by, radius=constants.LIGHT_RADIUS):
+        radius = self._radius(radius)
+        if (ax - bx) ** 2 + (ay - by) ** 2 > radius * radius:
+            return False
+        height = self.grid.height
+        visible = self.cached(ax, ay, radius)
+        if visible is not None:
+            self.hits += 1
+            return bx * height + by in visible
+        return ax * height + ay in self.visible_from(bx, by, radius)
+
+    def line_of_sight(self, x0, y0, x1, y1):
+        # Bresenham line, blocked by any wall between the two ends
+        block_path = self.grid.block_path
+        height = self.grid.height
+        dx, dy = abs(x1 - x0), abs(y1 - y0)
+        step_x = 1 if x1 > x0 else -1
+        step_y = 1 if y1 > y0 else -1
+        err = dx - dy
+        x, y = x0, y0
+        if x == x1 and y == y1:
+            return True
+        while True:
+            e2 = 2 * err
+            if e2 > -dy:
+                err -= dy
+                x += step_x
+            if e2 < dx:
+                err += dx
+                y += step_y
+            if x == x1 and y == y1:
+                return True
+            if block_path[x * height + y]:
+                return False